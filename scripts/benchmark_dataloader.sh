@@ -0,0 +1,3 @@
+python3 \
+    ../../src/benchmark_dataloader.py \
+    ../../configs/user_configs/<YOUR_CONFIG_HERE>.yaml
\ No newline at end of file
@@ -0,0 +1,3 @@
+python3 \
+    ../../src/benchmark_tokenizer.py \
+    ../../configs/user_configs/<YOUR_CONFIG_HERE>.yaml
@@ -0,0 +1,182 @@
+import itertools
+import psutil
+import sys
+import time
+import torch.distributed as dist
+import yaml
+
+from dataset import DataModule
+from tabulate import tabulate
+from utils import Struct
+
+
+class WorkerMonitor():
+    """
+    Tracks the CPU time and peak resident memory of the processes that load
+    batches: the dataloader workers, or the main process when there are none.
+    Processes are sampled at most every interval seconds, so monitoring adds
+    little to the loop it measures.
+
+    Args:
+        iterator: Iterator of the DataLoader being measured.
+        interval (float): Minimum number of seconds between two samples.
+    """
+    def __init__(self, iterator, interval: float=0.5):
+        # Workers are started by the DataLoader iterator; without workers the
+        # batches are loaded in this process
+        workers = getattr(iterator, "_workers", None)
+        self.processes = [psutil.Process(worker.pid) for worker in workers] \
+            if workers else [psutil.Process()]
+        self.interval = interval
+        self.last_sample = None
+        # Only the CPU time spent after the monitor starts is counted
+        self.start_cpu = [0.0] * len(self.processes) if workers else \
+            [self.cpu_time(self.processes[0])]
+        self.cpu = list(self.start_cpu)
+        self.peak_rss = [0] * len(self.processes)
+
+    @staticmethod
+    def cpu_time(process) -> float:
+        """ User plus system CPU seconds of a process. """
+        times = process.cpu_times()
+        return times.user + times.system
+
+    def sample(self, force: bool=False):
+        """ Record the CPU time and resident memory of every process.
+        Args:
+            force (bool): Sample even if the last sample is recent.
+        """
+        now = time.perf_counter()
+        if not force and self.last_sample is not None and \
+                now - self.last_sample < self.interval:
+            return
+        self.last_sample = now
+        for i, process in enumerate(self.processes):
+            try:
+                self.cpu[i] = self.cpu_time(process)
+                self.peak_rss[i] = max(self.peak_rss[i],
+                                       process.memory_info().rss)
+            except psutil.NoSuchProcess:
+                # Workers exit once they run out of data
+                pass
+
+    def cpu_seconds(self) -> list:
+        """ CPU seconds each process spent since the monitor started. """
+        return [cpu - start for cpu, start in zip(self.cpu, self.start_cpu)]
+
+def init_process_group():
+    """ DataSet splits the data by DDP rank, so benchmarking outside of a
+    Trainer needs a single-process group.
+    """
+    if not dist.is_initialized():
+        dist.init_process_group("gloo", store=dist.HashStore(), rank=0,
+                                world_size=1)
+
+def run_setting(config: Struct, num_batches: int) -> dict:
+    """ Iterate the training dataloader of one setting for up to num_batches
+    batches, without a model.
+    Args:
+        config (Struct): Configuration of the setting.
+        num_batches (int): Maximum number of batches to load.
+
+    Returns:
+        A dict with the measurements of the run.
+    """
+    data_module = DataModule(config)
+    dataset = data_module.build_dataset("train")
+    dataloader = data_module.build_dataloader(dataset)
+
+    start_time = time.perf_counter()
+    iterator = iter(dataloader)
+    monitor = WorkerMonitor(iterator)
+
+    first_batch_time = None
+    batches = samples = tokens = 0
+    # Throughput is measured after the first batch, so that it isn't skewed by
+    # starting the workers and filling their buffers
+    for batch in itertools.islice(iterator, num_batches):
+        if first_batch_time is None:
+            first_batch_time = time.perf_counter()
+        else:
+            samples += batch.x.shape[0]
+            tokens += int((batch.x != data_module.pad_token_id).sum())
+        batches += 1
+        monitor.sample()
+    end_time = time.perf_counter()
+    monitor.sample(force=True)
+    # Shut the workers down before the next setting starts its own
+    del iterator
+
+    elapsed = end_time - (first_batch_time or end_time)
+    cpu_seconds = monitor.cpu_seconds()
+    return {
+        "batches": batches,
+        "first_batch": (first_batch_time or end_time) - start_time,
+        "samples_per_sec": samples / elapsed if elapsed > 0 else 0.0,
+        "tokens_per_sec": tokens / elapsed if elapsed > 0 else 0.0,
+        # CPU use of the average worker over the whole run
+        "worker_cpu": sum(cpu_seconds) / len(cpu_seconds) / \
+            max(end_time - start_time, 1e-9),
+        "worker_rss": max(monitor.peak_rss)}
+
+def benchmark_dataloader(config):
+    """
+    Load training batches for every combination of the candidate dataset
+    formats, packing modes, worker counts and batch sizes, without a model,
+    and report how fast the dataloader delivers them and what the workers
+    cost in CPU and memory.
+    """
+    init_process_group()
+
+    results = []
+    for dataset_format, packing, num_workers, batch_size in itertools.product(
+            config.benchmark_formats, config.benchmark_packing,
+            config.benchmark_num_workers, config.benchmark_batch_sizes):
+        print(f"Benchmarking {dataset_format} data, packing={packing}, " + \
+            f"num_workers={num_workers}, batch_size={batch_size}")
+        setting = Struct(**config.get_config_dict())
+        setting.dataset_format = dataset_format
+        setting.packing = packing
+        setting.num_workers = num_workers
+        setting.batch_size = batch_size
+        # Measure the dataloader itself, not the prefetching thread
+        setting.prefetch_batches = 0
+
+        try:
+            result = run_setting(setting, config.benchmark_batches)
+        except AssertionError as e:
+            # E.g. the training split hasn't been tokenized in this format
+            print(f"Skipping: {e}")
+            continue
+
+        results.append([
+            dataset_format,
+            packing,
+            num_workers,
+            batch_size,
+            result["batches"],
+            f"{result['first_batch']:.2f}",
+            f"{result['samples_per_sec']:,.1f}",
+            f"{result['tokens_per_sec']:,.0f}",
+            f"{result['worker_cpu']:.0%}",
+            f"{result['worker_rss'] / 2**20:,.0f}"])
+
+    print(f"\nTraining dataloader throughput over up to " + \
+        f"{config.benchmark_batches} batches:")
+    print(tabulate(results, headers=[
+        "Format", "Packing", "Workers", "Batch size", "Batches",
+        "First batch (s)", "Samples/sec", "Tokens/sec", "CPU/worker",
+        "Peak RSS/worker (MiB)"],
+        tablefmt="grid"))
+
+
+if __name__ == "__main__":
+    args = sys.argv
+    config_path = args[1]
+
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f)
+
+    config = Struct(**config)
+
+    benchmark_dataloader(config)
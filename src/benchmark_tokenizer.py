@@ -0,0 +1,148 @@
+import numpy as np
+import pyarrow.parquet as pq
+import sys
+import time
+import torch
+import yaml
+
+from dask.diagnostics import ProgressBar
+from models import LongNetModel, RetNetModel, TransformerModel
+from pathlib import Path
+from tabulate import tabulate
+from train_tokenizer import count_train_pre_tokens, iter_texts, sample_texts, \
+    split_byte_budgets, train_bpe
+from utils import Struct
+
+
+def build_model(config: Struct, vocab_size: int):
+    """ Build the configured model on the meta device, so no memory is
+    allocated for its weights.
+    Args:
+        config (Struct): A Struct object with all configuration fields.
+        vocab_size (int): Vocabulary size to build the model with.
+    """
+    model_config = Struct(**config.get_config_dict())
+    model_config.vocab_size = vocab_size
+    with torch.device("meta"):
+        if config.model_type.lower() == "longnet":
+            return LongNetModel(model_config)
+        elif config.model_type.lower() == "retnet":
+            return RetNetModel(model_config)
+        elif config.model_type.lower() == "transformer":
+            return TransformerModel(model_config)
+        else:
+            raise ValueError(f"Model type '{config.model_type}' not supported!")
+
+def count_params(config: Struct) -> tuple:
+    """ Split the model's parameter count into a part that doesn't depend on
+    the vocabulary size and a part per vocabulary entry (token embedding and
+    output projection), by building the model with two vocabulary sizes.
+    Args:
+        config (Struct): A Struct object with all configuration fields.
+    """
+    params = [sum(p.numel() for p in build_model(config, vocab_size).parameters())
+              for vocab_size in (1000, 2000)]
+    params_per_token = (params[1] - params[0]) // 1000
+    return params[0] - 1000 * params_per_token, params_per_token
+
+def split_text_bytes(split_dir: Path, feature: str) -> int:
+    """ Uncompressed size of the text column of a split, from the parquet
+    footers only.
+    Args:
+        split_dir (Path): Folder of the raw split.
+        feature (str): Column holding the text.
+    """
+    num_bytes = 0
+    for path in sorted(split_dir.glob("*.parquet")):
+        metadata = pq.ParquetFile(path).metadata
+        column = metadata.schema.names.index(feature)
+        num_bytes += sum(
+            metadata.row_group(i).column(column).total_uncompressed_size
+            for i in range(metadata.num_row_groups))
+    return num_bytes
+
+def benchmark_tokenizer(config):
+    """
+    Train a tokenizer for every candidate vocabulary size on a sample of the
+    training split, and report how well each compresses held-out text, how
+    fast it tokenizes, and what it would cost to train the configured model
+    on the whole training split with it.
+    """
+    raw_dir = Path(config.raw_dataset_path)
+
+    print("Sampling evaluation documents from the validation split")
+    eval_paths = sorted((raw_dir / "validation").glob("*.parquet"))
+    eval_texts = []
+    for i, (path, budget) in enumerate(zip(
+            eval_paths,
+            split_byte_budgets(eval_paths, config.benchmark_sample_bytes))):
+        eval_texts.extend(sample_texts(
+            iter_texts(path, config.dataset_feature), budget,
+            np.random.default_rng([config.rand_seed or 0, i])))
+    eval_bytes = sum(len(text.encode()) for text in eval_texts)
+
+    print("Counting pre-tokens of the training sample")
+    counts = count_train_pre_tokens(config, config.benchmark_sample_bytes)
+
+    # Cost model of the configured architecture
+    base_params, params_per_token = count_params(config)
+    train_bytes = split_text_bytes(raw_dir / "train", config.dataset_feature)
+    bytes_per_value = 2 if "16" in str(config.precision) else 4
+
+    results = []
+    for vocab_size in config.benchmark_vocab_sizes:
+        print(f"Training tokenizer with vocab size {vocab_size}")
+        tokenizer = train_bpe(counts, vocab_size, show_progress=False)
+
+        start_time = time.time()
+        encodings = tokenizer.encode_batch(eval_texts)
+        elapsed = time.time() - start_time
+        # Leave out the <bos> token added to every document
+        num_tokens = sum(len(encoding.ids) - 1 for encoding in encodings)
+        bytes_per_token = eval_bytes / num_tokens
+
+        # Training FLOPs per token: 6 per weight used in a matmul (the token
+        # embedding is a lookup), plus the attention/retention scores
+        params = base_params + params_per_token * vocab_size
+        flops_per_token = 6 * (params - config.embed_dim * vocab_size) + \
+            6 * config.layers * config.seq_len * config.embed_dim
+        train_tokens = train_bytes / bytes_per_token
+
+        # Memory that grows with the vocabulary: fp32 weights, gradients and
+        # Adam moments of the embedding/output projection, and the logits of a
+        # batch plus their gradient
+        vocab_memory = 16 * params_per_token * vocab_size
+        logits_memory = 2 * bytes_per_value * config.batch_size * \
+            config.seq_len * vocab_size
+
+        results.append([
+            vocab_size,
+            f"{bytes_per_token:.3f}",
+            f"{num_tokens / elapsed:,.0f}",
+            f"{eval_bytes / elapsed / 2**20:.1f}",
+            f"{train_tokens:.3e}",
+            f"{params:,}",
+            f"{flops_per_token * train_tokens:.3e}",
+            f"{vocab_memory / 2**30:.2f}",
+            f"{logits_memory / 2**30:.2f}"])
+
+    print(f"\nCost of training the {config.model_type} model for one epoch " + \
+        f"on the training split ({train_bytes:,} bytes of text):")
+    print(tabulate(results, headers=[
+        "Vocab size", "Bytes/token", "Tokens/sec", "MiB/sec", "Train tokens",
+        "Parameters", "Train FLOPs", "Vocab state (GiB)", "Logits (GiB)"],
+        tablefmt="grid"))
+
+
+if __name__ == "__main__":
+    ProgressBar().register()
+
+    args = sys.argv
+    config_path = args[1]
+
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f)
+
+    config = Struct(**config)
+
+    benchmark_tokenizer(config)
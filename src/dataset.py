@@ -1,13 +1,22 @@
-import dask
-dask.config.set({"dataframe.query-planning": True})
-import dask.dataframe as dd
+import heapq
+import itertools
+import json
 import numpy as np
+import os
+import pyarrow.parquet as pq
+import threading
+import time
 import torch
+import uuid
 
 from pathlib import Path
 from pytorch_lightning import LightningDataModule
+from queue import Empty, Full, Queue
 from torch.utils.data import DataLoader, get_worker_info
-from torch.distributed import get_rank, get_world_size
+from torch.distributed import all_gather_object, get_rank, get_world_size, \
+    is_initialized
+from tokenize_data import load_tokenizer, token_dtype, tokenize_partition, \
+    tokenizer_fingerprint
 from transformers import PreTrainedTokenizerFast
 from utils import Struct
 
@@ -27,12 +36,106 @@ class DataModule(LightningDataModule):
         self.batch_size = config.batch_size
         self.num_workers = config.num_workers
         self.tokenized_dataset_path = Path(config.tokenized_dataset_path)
+        self.raw_dataset_path = Path(config.raw_dataset_path)
+        self.dataset_format = config.dataset_format
+        self.dataset_feature = config.dataset_feature
+        self.tokenizer_path = config.tokenizer_path
+        self.tokenize_batch_size = config.tokenize_batch_size
         self.seq_len = config.seq_len
+        self.packing = config.packing
+        self.max_tokens = config.max_tokens
+        self.num_length_buckets = config.num_length_buckets
+        self.batch_shuffle_window = config.batch_shuffle_window
+        self.shuffle_buffer_size = config.shuffle_buffer_size
+        self.rand_seed = config.rand_seed
+        self.pin_memory = config.pin_memory
+        self.prefetch_batches = config.prefetch_batches
+        self.val_subset_tokens = config.val_subset_tokens
+
+        # Fixed validation batches, when validating on a subset
+        self.val_batches = None
 
         # Instantiate tokenizer to get the pad/eos ids
         tokenizer = PreTrainedTokenizerFast.from_pretrained(config.tokenizer_path)
         self.pad_token_id = tokenizer.pad_token_id
 
+        # Every tokenized document starts with <bos>, so it also separates
+        # documents that are packed into the same window
+        self.sep_token_id = tokenizer.bos_token_id
+
+        if self.dataset_format == "raw":
+            # Token caches are only valid for the tokenizer that wrote them
+            self.token_cache_path = Path(config.token_cache_path) / \
+                tokenizer_fingerprint(tokenizer)[:16]
+            # Threads of the Rust tokenizer in every dataloader worker; must be
+            # set before the workers start
+            os.environ["RAYON_NUM_THREADS"] = str(config.tokenizer_threads)
+
+        # Position of every training dataloader worker in the current epoch
+        self.train_positions = {}
+        self.train_positions_epoch = None
+        self.resume_positions = None
+
+    def build_dataset(self, split: str):
+        """ Create the DataSet for one split of the tokenized dataset.
+        Args:
+            split (str): Either "train", "validation", or "test".
+        """
+        if self.dataset_format == "raw":
+            path_to_data = self.raw_dataset_path / split
+            cache_path = self.token_cache_path / split
+        else:
+            path_to_data = self.tokenized_dataset_path / split
+            cache_path = None
+
+        dataset = DataSet(path_to_data,
+                       self.seq_len,
+                       self.pad_token_id,
+                       dataset_format=self.dataset_format,
+                       packing=self.packing,
+                       sep_token_id=self.sep_token_id,
+                       # Only training batches are sized by a token budget
+                       max_tokens=self.max_tokens if split == "train" else None,
+                       num_length_buckets=self.num_length_buckets,
+                       batch_shuffle_window=self.batch_shuffle_window,
+                       # Only training data is shuffled
+                       shuffle_buffer_size=self.shuffle_buffer_size \
+                           if split == "train" else 0,
+                       rand_seed=self.rand_seed,
+                       feature=self.dataset_feature,
+                       tokenizer_path=self.tokenizer_path,
+                       cache_path=cache_path,
+                       tokenize_batch_size=self.tokenize_batch_size)
+
+        # Split statistics come from the shard indices, without scanning data
+        num_tokens = "unknown number of" if dataset.num_tokens is None \
+            else f"{dataset.num_tokens:,}"
+        print(f"Loaded {split} split: {dataset.num_documents:,} documents, " + \
+            f"{num_tokens} tokens, {dataset.length:,} " + \
+            f"{'batches' if dataset.max_tokens else 'samples'} per epoch")
+        return dataset
+
+    def build_dataloader(self, dataset):
+        """ Create a PyTorch DataLoader over a DataSet.
+        Args:
+            dataset (DataSet): Dataset to load batches from.
+        """
+        dataloader = EpochDataLoader(
+            dataset=dataset,
+            # Token-budget datasets already yield whole batches
+            batch_size=None if dataset.max_tokens else self.batch_size,
+            collate_fn=dataset.pad_to_longest,
+            num_workers=self.num_workers,
+            pin_memory=self.pin_memory)
+        if not self.prefetch_batches:
+            return dataloader
+
+        # Batches are staged on the device the model trains on
+        device = None
+        if self.trainer is not None:
+            device = self.trainer.strategy.root_device
+        return PrefetchLoader(dataloader, self.prefetch_batches, device)
+
     def setup(self, stage: str):
         """ Setup for each stage -- called on every process on DDP.
         Args:
@@ -40,44 +143,575 @@ class DataModule(LightningDataModule):
         """
         if stage == "fit":
             # Load datasets
-            self.train_dataset = DataSet(self.tokenized_dataset_path / "train",
-                                         self.seq_len,
-                                         self.pad_token_id)
+            self.train_dataset = self.build_dataset("train")
+            self.train_dataset.resume_positions = self.resume_positions
             
-            self.val_dataset = DataSet(self.tokenized_dataset_path / "validation",
-                                        self.seq_len,
-                                        self.pad_token_id)
+            self.val_dataset = self.build_dataset("validation")
+
+            # Draw the validation subset once; every validation pass reuses it
+            if self.val_subset_tokens:
+                self.val_batches = self.val_dataset.sample_batches(
+                    self.val_subset_tokens, self.batch_size)
+                if self.pin_memory and torch.cuda.is_available():
+                    self.val_batches = [batch.pin_memory()
+                                        for batch in self.val_batches]
             
         if stage == "test":
             # Load dataset
-            self.test_dataset = DataSet(self.tokenized_dataset_path / "test",
-                                         self.seq_len,
-                                         self.pad_token_id)
+            self.test_dataset = self.build_dataset("test")
 
     def train_dataloader(self):
         """ Return training PyTorch DataLoader. """
-        return DataLoader(
-            dataset=self.train_dataset,
-            batch_size=self.batch_size,
-            collate_fn=self.train_dataset.pad_to_longest, 
-            num_workers=self.num_workers)
+        # Start from the epoch restored from a checkpoint, if any
+        if self.trainer is not None:
+            self.train_dataset.epoch = self.trainer.current_epoch
+        return self.build_dataloader(self.train_dataset)
 
     def val_dataloader(self):
-        """ Return validation PyTorch DataLoader. """
+        """ Return validation PyTorch DataLoader, or this rank's share of the
+        fixed validation batches when validating on a subset.
+        """
+        if self.val_batches is None:
+            return self.build_dataloader(self.val_dataset)
+
+        # Every rank gets the same number of batches
+        rank, world_size = 0, 1
+        if self.trainer is not None:
+            rank, world_size = self.trainer.global_rank, self.trainer.world_size
+        num_batches = len(self.val_batches) // world_size
+        assert num_batches > 0, \
+            f"val_subset_tokens ({self.val_subset_tokens}) is too small to " + \
+            f"give each of the {world_size} ranks a batch."
+        # Lightning would take a plain list for a list of dataloaders
         return DataLoader(
-            dataset=self.val_dataset,
-            batch_size=self.batch_size,
-            collate_fn=self.val_dataset.pad_to_longest, 
-            num_workers=self.num_workers)
+            self.val_batches[rank * num_batches:(rank + 1) * num_batches],
+            batch_size=None)
 
     def test_dataloader(self):
         """ Return testing PyTorch DataLoader. """
-        return DataLoader(
-            dataset=self.test_dataset,
-            batch_size=self.batch_size,
-            collate_fn=self.test_dataset.pad_to_longest,
-            num_workers=self.num_workers)
+        return self.build_dataloader(self.test_dataset)
+
+    def on_before_batch_transfer(self, batch, dataloader_idx: int):
+        """ Record how far each training dataloader worker has gotten, using
+        the position the worker attached to the batch. Called by Lightning
+        for every batch actually consumed, so prefetched batches don't count.
+        """
+        if self.trainer is None or not self.trainer.training:
+            return batch
+
+        # Positions only carry over within one epoch
+        if self.train_positions_epoch != self.trainer.current_epoch:
+            if self.train_positions_epoch is not None:
+                self.resume_positions = None
+            self.train_positions = {}
+            self.train_positions_epoch = self.trainer.current_epoch
+
+        self.train_positions[batch.position["process_id"]] = batch.position
+
+        # Workers of the resumed epoch have already been started, so later
+        # epochs start from the beginning again
+        if self.train_dataset.resume_positions is not None:
+            self.train_dataset.resume_positions = None
+
+        return batch
+
+    def state_dict(self) -> dict:
+        """ Dataloader state saved by Lightning with every checkpoint,
+        including the checkpoint written when Slurm requeues the job. Lightning
+        builds the checkpoint on every rank but only rank 0 writes it, so the
+        positions of the workers of all ranks are gathered.
+        """
+        rank, world_size = 0, 1
+        if self.trainer is not None:
+            rank, world_size = self.trainer.global_rank, self.trainer.world_size
+        num_workers = max(self.num_workers, 1)
+        total_processes = num_workers * world_size
+
+        # Workers that haven't had a batch consumed yet start from scratch
+        positions = {process_id: {
+            "process_id": process_id,
+            "total_processes": total_processes,
+            "epoch": self.train_positions_epoch,
+            "items": 0,
+            "seed": None}
+            for process_id in range(rank * num_workers,
+                                    (rank + 1) * num_workers)}
+        positions.update({
+            process_id: position
+            for process_id, position in self.train_positions.items()
+            if process_id in positions and
+                position["total_processes"] == total_processes})
+
+        if world_size > 1 and is_initialized():
+            rank_positions = [None] * world_size
+            all_gather_object(rank_positions, positions)
+            positions = {process_id: position
+                         for rank_position in rank_positions
+                         for process_id, position in rank_position.items()}
+
+        return {
+            "epoch": self.train_positions_epoch,
+            "positions": positions}
+
+    def load_state_dict(self, state_dict: dict):
+        """ Restore the dataloader state, so that a resumed job continues each
+        training worker from where it left off.
+        """
+        positions = dict(state_dict["positions"])
+        saved_processes = {position["total_processes"]
+                           for position in positions.values()}
+        missing = [process_id for process_id in
+                   range(max(saved_processes, default=0))
+                   if process_id not in positions]
+        if len(saved_processes) > 1 or missing:
+            raise ValueError(
+                "The dataloader state in the checkpoint has no position " + \
+                f"for processes {missing}, so their ranks can't resume " + \
+                "where they left off.")
+
+        self.train_positions = dict(positions)
+        self.train_positions_epoch = state_dict["epoch"]
+        self.resume_positions = positions or None
+        if hasattr(self, "train_dataset"):
+            self.train_dataset.resume_positions = self.resume_positions
     
+class EpochDataLoader(DataLoader):
+    """
+    DataLoader that advances the epoch of its DataSet every time a new pass
+    over it starts, so that each epoch is shuffled differently. Dataloader
+    workers get a copy of the dataset when a pass starts, so the epoch can't
+    be set from inside them.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.passes = 0
+
+    def __iter__(self):
+        if self.passes > 0:
+            self.dataset.epoch += 1
+        self.passes += 1
+        return super().__iter__()
+
+    def __len__(self):
+        """
+        Number of batches this rank loads per pass. Every worker yields the
+        same number of items, and batches them on its own.
+        """
+        num_workers = max(self.num_workers, 1)
+        num_items = self.dataset.num_items(num_workers * get_world_size())
+        if self.batch_size is None:
+            return num_workers * num_items
+        return num_workers * -(-num_items // self.batch_size)
+
+class PrefetchLoader():
+    """
+    Wraps a DataLoader so that a background thread keeps up to num_batches
+    batches ready in a bounded queue, so a slow batch from the dataloader
+    workers doesn't stall the training step right away. On CUDA devices, the
+    thread also copies every (pinned) batch to the device on a separate CUDA
+    stream, overlapping the copy with the current step. After every pass, it
+    reports how often the training loop had to wait for a batch.
+
+    Args:
+        dataloader (DataLoader): DataLoader to prefetch batches from.
+        num_batches (int): Maximum number of batches held ready.
+        device (torch.device): Device to stage batches on, or None to leave
+            them on the host.
+    """
+    # Marks the end of a pass in the queue
+    END = object()
+
+    def __init__(self, dataloader, num_batches: int, device=None):
+        self.dataloader = dataloader
+        self.num_batches = num_batches
+        self.device = device
+        self.stream = None
+        if device is not None and device.type == "cuda":
+            self.stream = torch.cuda.Stream(device)
+
+        # Statistics of the last pass
+        self.stats = None
+
+    @property
+    def dataset(self):
+        """ DataSet of the wrapped DataLoader. """
+        return self.dataloader.dataset
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def stage(self, batch):
+        """ Start copying a batch to the device on the copy stream, and return
+        it with the event that marks the end of the copy.
+        """
+        if self.stream is None:
+            return batch, None
+        with torch.cuda.stream(self.stream):
+            batch = batch.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return batch, event
+
+    def produce(self, queue: Queue, stop: threading.Event):
+        """ Fill the queue with staged batches until the pass ends or the
+        consumer stops. Exceptions are passed on to the consumer.
+        """
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        try:
+            for batch in self.dataloader:
+                if not put(self.stage(batch)):
+                    return
+            put(self.END)
+        except Exception as e:
+            put(e)
+
+    def __iter__(self):
+        queue = Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.produce, args=(queue, stop),
+                                  daemon=True)
+        thread.start()
+
+        num_batches = 0
+        num_waits = 0
+        wait_time = 0.0
+        start_time = time.perf_counter()
+        try:
+            while True:
+                waited = False
+                try:
+                    item = queue.get_nowait()
+                except Empty:
+                    # The training loop is waiting on data
+                    wait_start = time.perf_counter()
+                    item = queue.get()
+                    waited = True
+                    wait_time += time.perf_counter() - wait_start
+
+                if item is self.END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                # Only waits for batches count, not the one for the end marker
+                num_waits += waited
+
+                batch, event = item
+                if event is not None:
+                    # Wait for the copy, and keep the copy stream's memory from
+                    # being reused while the current stream still needs it
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    batch.record_stream(stream)
+                num_batches += 1
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+            elapsed = time.perf_counter() - start_time
+            self.stats = {
+                "batches": num_batches,
+                "waits": num_waits,
+                "wait_time": wait_time,
+                "elapsed": elapsed}
+            if num_batches > 0:
+                print(f"Waited on data for {num_waits} of {num_batches} " + \
+                    f"batches ({wait_time:.2f} s, " + \
+                    f"{wait_time / max(elapsed, 1e-9):.2%} of the pass)")
+
+class WindowBatch():
+    """
+    Batch of token windows stored in a single (batch size, length + 1) buffer.
+    Inputs and targets are views of the buffer shifted by one token, so the
+    batch is pinned and copied to the device as one tensor. Unpacks like an
+    (x, y_true) tuple.
+
+    Args:
+        windows (Tensor): Long tensor of padded token windows.
+        position (dict): Position of the dataloader worker that produced the
+            batch, right after producing it.
+        segments (Tensor): Document segment id of every token of the windows,
+            for packed windows; None otherwise.
+    """
+    def __init__(self, windows: torch.Tensor, position: dict=None,
+                 segments: torch.Tensor=None):
+        self.windows = windows
+        self.position = position
+        self.segments = segments
+
+    @property
+    def x(self) -> torch.Tensor:
+        """ Input tokens of every window. """
+        return self.windows[:, :-1]
+
+    @property
+    def y_true(self) -> torch.Tensor:
+        """ Target tokens of every window. """
+        return self.windows[:, 1:]
+
+    @property
+    def segment_ids(self) -> torch.Tensor:
+        """ Document segment ids of the input tokens, or None. """
+        if self.segments is None:
+            return None
+        return self.segments[:, :-1]
+
+    def __iter__(self):
+        return iter((self.x, self.y_true))
+
+    def __getitem__(self, index: int) -> torch.Tensor:
+        return (self.x, self.y_true)[index]
+
+    def __len__(self):
+        return 2
+
+    def pin_memory(self):
+        """ Called by the DataLoader when pin_memory is enabled. """
+        return WindowBatch(
+            self.windows.pin_memory(), self.position,
+            None if self.segments is None else self.segments.pin_memory())
+
+    def to(self, *args, **kwargs):
+        """ Called by Lightning to move the batch to the device. Copies from
+        pinned memory are asynchronous when non_blocking is passed.
+        """
+        return WindowBatch(
+            self.windows.to(*args, **kwargs), self.position,
+            None if self.segments is None else self.segments.to(*args, **kwargs))
+
+    def record_stream(self, stream):
+        """ Mark the batch's device memory as used by a CUDA stream. """
+        self.windows.record_stream(stream)
+        if self.segments is not None:
+            self.segments.record_stream(stream)
+
+def read_shard_index(index_path: Path) -> dict:
+    """ Read the sidecar index that tokenize_data.py writes next to every
+    shard, holding its document count, token count and length histogram.
+    Returns None for shards tokenized before indices were written.
+    Args:
+        index_path (Path): Path to the shard's '.index.json' file.
+    """
+    if not index_path.exists():
+        return None
+    with open(index_path, "r") as f:
+        return json.load(f)
+
+def sum_length_histograms(histograms: list) -> dict:
+    """ Add up document length histograms of several shards. Bin i counts the
+    documents whose length has bit length i, i.e. lies in [2^(i-1), 2^i).
+    Args:
+        histograms (List[dict]): Histograms with "counts" and "tokens" lists.
+    """
+    num_bins = max(len(histogram["counts"]) for histogram in histograms)
+    total = {"counts": [0] * num_bins, "tokens": [0] * num_bins}
+    for histogram in histograms:
+        for key in total:
+            for i, value in enumerate(histogram[key]):
+                total[key][i] += value
+    return total
+
+class TokenShard():
+    """
+    Read-only view of one shard written by tokenize_data.py in the "memmap"
+    format. The token array and offsets index are mapped with numpy.memmap, so
+    documents are zero-copy slices and every process reading the shard shares
+    the same pages in the OS page cache.
+
+    Args:
+        tokens_path (Path): Path to the shard's '.tokens.npy' file.
+    """
+    def __init__(self, tokens_path: Path):
+        offsets_path = tokens_path.with_name(
+            tokens_path.name.replace(".tokens.npy", ".offsets.npy"))
+        self.tokens = np.load(tokens_path, mmap_mode="r")
+        self.offsets = np.load(offsets_path, mmap_mode="r")
+        self.index = read_shard_index(tokens_path.with_name(
+            tokens_path.name.replace(".tokens.npy", ".index.json")))
+
+    def __len__(self):
+        """ Number of documents in the shard. """
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        """ Token ids of a single document. """
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+    def count_tokens(self) -> int:
+        """ Number of tokens in the shard. """
+        return int(self.offsets[-1])
+
+    def document_lengths(self) -> np.ndarray:
+        """ Number of tokens of every document, from the offsets index. """
+        return np.diff(self.offsets)
+
+    def iter_documents(self, start: int, stop: int):
+        """ Yields documents start to stop (exclusive) of the shard. """
+        for index in range(start, stop):
+            yield self[index]
+
+class ParquetShard():
+    """
+    One parquet file of a dataset written by tokenize_data.py in the "parquet"
+    format. Row counts come from the parquet footer, so only the row groups
+    that overlap a requested range of documents are ever read.
+
+    Args:
+        path (Path): Path to the parquet file.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        metadata = pq.ParquetFile(path).metadata
+        row_counts = [metadata.row_group(i).num_rows
+                      for i in range(metadata.num_row_groups)]
+        self.row_group_offsets = np.concatenate([[0], np.cumsum(row_counts)])
+        self.index = read_shard_index(path.with_suffix(".index.json"))
+        self.lengths_path = path.with_suffix(".lengths.npy")
+
+    def __len__(self):
+        """ Number of documents in the shard. """
+        return int(self.row_group_offsets[-1])
+
+    def read_row_group(self, parquet_file, row_group: int):
+        """ Read the token lists of one row group as a flat NumPy array of
+        token ids plus an offsets index, without copying.
+        """
+        column = parquet_file.read_row_group(
+            row_group,
+            columns=parquet_file.schema_arrow.names[:1]).column(0)
+        column = column.combine_chunks()
+        return column.values.to_numpy(), column.offsets.to_numpy()
+
+    def count_tokens(self) -> int:
+        """ Number of tokens in the shard. Without an index, this reads the
+        whole file.
+        """
+        if self.index is not None:
+            return self.index["tokens"]
+        parquet_file = pq.ParquetFile(self.path)
+        return sum(int(self.read_row_group(parquet_file, i)[1][-1])
+                   for i in range(len(self.row_group_offsets) - 1))
+
+    def document_lengths(self) -> np.ndarray:
+        """ Number of tokens of every document, mapped from the shard's
+        '.lengths.npy' file, or None for shards written without one.
+        """
+        if not self.lengths_path.exists():
+            return None
+        return np.load(self.lengths_path, mmap_mode="r")
+
+    def iter_documents(self, start: int, stop: int):
+        """ Yields documents start to stop (exclusive) of the shard. """
+        parquet_file = pq.ParquetFile(self.path)
+        first_row_group = np.searchsorted(
+            self.row_group_offsets, start, side="right") - 1
+        for row_group in range(first_row_group, len(self.row_group_offsets) - 1):
+            row_group_start = self.row_group_offsets[row_group]
+            if row_group_start >= stop:
+                break
+            tokens, offsets = self.read_row_group(parquet_file, row_group)
+            row_group_stop = min(stop, self.row_group_offsets[row_group + 1])
+            for index in range(max(start, row_group_start) - row_group_start,
+                               row_group_stop - row_group_start):
+                yield tokens[offsets[index]:offsets[index + 1]]
+
+class RawShard(ParquetShard):
+    """
+    One raw text parquet file, tokenized on the fly by the dataloader workers
+    for the "raw" format. Every row group is tokenized as a whole the first
+    time it is read and cached as a flat token array plus an offsets index,
+    so later reads map the cached tokens with numpy.memmap like TokenShard.
+    Caches older than the raw file are ignored.
+
+    Args:
+        path (Path): Path to the raw parquet file.
+        feature (str): Column holding the text.
+        tokenizer_path (str): Path to the tokenizer folder.
+        cache_dir (Path): Folder of the token cache.
+        batch_size (int): Number of documents encoded per tokenizer call.
+    """
+    def __init__(self, path: Path, feature: str, tokenizer_path: str,
+                 cache_dir: Path, batch_size: int):
+        super().__init__(path)
+        self.feature = feature
+        self.tokenizer_path = tokenizer_path
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.dtype = token_dtype(len(load_tokenizer(tokenizer_path)))
+
+    def cache_prefix(self, row_group: int) -> Path:
+        """ Path prefix of a row group's '.tokens.npy' and '.offsets.npy'
+        cache files.
+        """
+        return self.cache_dir / f"{self.path.stem}.{row_group}"
+
+    def is_cached(self, row_group: int) -> bool:
+        """ Whether an up-to-date cache of the row group exists. The tokens
+        file is written last, so it only exists once the cache is complete.
+        """
+        tokens_path = Path(f"{self.cache_prefix(row_group)}.tokens.npy")
+        return tokens_path.exists() and \
+            tokens_path.stat().st_mtime >= self.path.stat().st_mtime
+
+    def read_row_group(self, parquet_file, row_group: int):
+        """ Read the token ids of one row group as a flat NumPy array plus an
+        offsets index, from the cache if possible, otherwise by tokenizing
+        its text and caching the result.
+        """
+        prefix = self.cache_prefix(row_group)
+        if self.is_cached(row_group):
+            return (np.load(f"{prefix}.tokens.npy", mmap_mode="r"),
+                    np.load(f"{prefix}.offsets.npy", mmap_mode="r"))
+
+        texts = parquet_file.read_row_group(
+            row_group, columns=[self.feature]).column(0).fill_null("").to_pylist()
+        tokens, offsets = tokenize_partition(
+            texts, self.tokenizer_path, self.dtype, self.batch_size)
+
+        # Workers whose documents share a row group may cache it at the same
+        # time, so each writes under its own temporary name; the tokens file
+        # goes last, since it marks the cache as complete
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        for suffix, array in ((".offsets.npy", offsets), (".tokens.npy", tokens)):
+            path = f"{prefix}{suffix}"
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+
+        return tokens, offsets
+
+    def count_tokens(self) -> int:
+        """ Number of tokens in the shard, or None until every row group has
+        been cached.
+        """
+        num_row_groups = len(self.row_group_offsets) - 1
+        if not all(self.is_cached(i) for i in range(num_row_groups)):
+            return None
+        return sum(int(np.load(f"{self.cache_prefix(i)}.offsets.npy",
+                               mmap_mode="r")[-1])
+                   for i in range(num_row_groups))
+
+    def document_lengths(self) -> np.ndarray:
+        """ Number of tokens of every document, or None until every row group
+        has been cached.
+        """
+        num_row_groups = len(self.row_group_offsets) - 1
+        if not all(self.is_cached(i) for i in range(num_row_groups)):
+            return None
+        return np.concatenate([
+            np.diff(np.load(f"{self.cache_prefix(i)}.offsets.npy",
+                            mmap_mode="r"))
+            for i in range(num_row_groups)])
+
 class DataSet(torch.utils.data.IterableDataset):
     """
     Dataset class for PyTorch IterableDataset. This class is used to load the
@@ -86,27 +720,325 @@ class DataSet(torch.utils.data.IterableDataset):
     Args:
         path_to_data (Path): Path to the tokenized dataset.
         seq_len (int): Sequence length during training.
+        pad_token_id (int): Token id used for padding.
+        dataset_format (str): Format written by tokenize_data.py, either
+            "parquet" or "memmap", or "raw" to tokenize raw text parquet
+            files on the fly.
+        packing (bool): Whether to pack documents into full windows of
+            seq_len + 1 tokens instead of truncating and padding each one.
+        sep_token_id (int): Token id placed between packed documents.
+        max_tokens (int): If given, yield whole batches whose padded size is
+            capped by this many tokens instead of single samples.
+        num_length_buckets (int): Number of length buckets used to group
+            samples of similar length when batching by max_tokens.
+        batch_shuffle_window (int): Number of ready batches held back and
+            shuffled when batching by max_tokens.
+        shuffle_buffer_size (int): Number of documents held in the streaming
+            shuffle buffer of each worker. 0 disables shuffling, including the
+            shuffling of the shard order.
+        rand_seed (int): Random seed for shuffling.
+        feature (str): Text column of the raw files, for the "raw" format.
+        tokenizer_path (str): Path to the tokenizer folder, for the "raw"
+            format.
+        cache_path (Path): Folder the "raw" format caches tokens in.
+        tokenize_batch_size (int): Number of documents encoded per tokenizer
+            call, for the "raw" format.
     """
-    def __init__(self, path_to_data, seq_len, pad_token_id):
+    def __init__(self, path_to_data, seq_len, pad_token_id,
+                 dataset_format="parquet", packing=False, sep_token_id=None,
+                 max_tokens=None, num_length_buckets=8,
+                 batch_shuffle_window=64, shuffle_buffer_size=0,
+                 rand_seed=None, feature="text", tokenizer_path=None,
+                 cache_path=None, tokenize_batch_size=1000):
         assert path_to_data.exists(), f"Path '{path_to_data}' does not exist."
-        # Read data with Dask
-        self.data = dd.read_parquet(path_to_data / "*.parquet")
+        self.dataset_format = dataset_format
+
+        if dataset_format == "parquet":
+            # Only the parquet footers are read here
+            self.shards = [ParquetShard(path)
+                           for path in sorted(path_to_data.glob("*.parquet"))]
+
+            # Packing needs the total token count to know the number of
+            # windows; without shard indices, counting reads every file
+            self.num_tokens = None
+            if packing or all(shard.index for shard in self.shards):
+                self.num_tokens = sum(
+                    shard.count_tokens() for shard in self.shards)
+        elif dataset_format == "memmap":
+            # Map every shard; forked dataloader workers inherit the mappings
+            self.shards = [TokenShard(path)
+                           for path in sorted(path_to_data.glob("*.tokens.npy"))]
 
-        # Get length of df
-        self.length = len(self.data)
+            # Token counts come straight from the offsets indices
+            self.num_tokens = sum(shard.count_tokens() for shard in self.shards)
+        elif dataset_format == "raw":
+            assert tokenizer_path is not None and cache_path is not None, \
+                "The raw format needs a tokenizer and a cache path."
+            self.shards = [RawShard(path, feature, tokenizer_path, cache_path,
+                                    tokenize_batch_size)
+                           for path in sorted(path_to_data.glob("*.parquet"))]
+
+            # Token counts are only known once everything has been cached
+            token_counts = [shard.count_tokens() for shard in self.shards]
+            self.num_tokens = None
+            if None not in token_counts:
+                self.num_tokens = sum(token_counts)
+            elif packing and self.shards:
+                # Estimate from the first row group, which is cached now
+                tokens, offsets = self.shards[0].read_row_group(
+                    pq.ParquetFile(self.shards[0].path), 0)
+                self.num_tokens = int(offsets[-1] / max(len(offsets) - 1, 1) * \
+                    sum(len(shard) for shard in self.shards))
+        else:
+            raise ValueError(f"Dataset format '{dataset_format}' not supported!")
+
+        assert self.shards, f"No data files found in '{path_to_data}'."
+        self.num_documents = sum(len(shard) for shard in self.shards)
+        self.length = self.num_documents
+
+        # Document length histogram of the whole split, if every shard has
+        # an index
+        self.length_histogram = None
+        if all(shard.index for shard in self.shards):
+            self.length_histogram = sum_length_histograms(
+                [shard.index["length_histogram"] for shard in self.shards])
+            # Empty documents don't make samples
+            self.length -= self.length_histogram["counts"][0]
 
         self.seq_len = seq_len
         self.pad_token_id = pad_token_id
+        self.packing = packing
+        self.sep_token_id = sep_token_id
+
+        if packing:
+            assert sep_token_id is not None, "Packing requires a separator token."
+            # Each packed window holds seq_len + 1 tokens (inputs plus shifted
+            # targets)
+            self.length = self.num_tokens // (self.seq_len + 1)
+
+        self.max_tokens = max_tokens
+        self.num_length_buckets = num_length_buckets
+        self.batch_shuffle_window = batch_shuffle_window
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.rand_seed = rand_seed
+
+        # Set by EpochDataLoader before every pass; seeds the shuffling
+        self.epoch = 0
+
+        # Set by DataModule when resuming from a checkpoint
+        self.resume_positions = None
+        self.position = None
+
+        if max_tokens:
+            assert max_tokens >= seq_len, \
+                f"max_tokens ({max_tokens}) must fit a full sequence ({seq_len})."
+
+        # Document lengths of every shard, when the shards know them without
+        # reading their tokens. They give the exact number of items of every
+        # process; otherwise, the number is estimated.
+        self.shard_lengths = [shard.document_lengths() for shard in self.shards]
+        if any(lengths is None for lengths in self.shard_lengths):
+            self.shard_lengths = None
+        self.counts_cache = {}
+
+        if self.shard_lengths is not None:
+            self.length = self.count_items(np.concatenate(self.shard_lengths))
+        elif max_tokens:
+            # Batch count depends on sample lengths, so estimate it from the
+            # number of tokens the samples can hold
+            sample_tokens = self.length * self.seq_len
+            if self.num_tokens is not None:
+                sample_tokens = min(sample_tokens, self.num_tokens)
+            self.length = -(-sample_tokens // max_tokens)
+
+        if self.shard_lengths is None and (max_tokens or packing):
+            print("Warning: Document lengths are unknown, so the number of " + \
+                f"{'batches' if max_tokens else 'windows'} per process is " + \
+                "estimated. Processes that run out early repeat some of " + \
+                "their data and the others drop the rest, to yield the same " + \
+                "number each.")
+
+    def count_items(self, lengths: np.ndarray) -> int:
+        """
+        Exact number of items iter_items yields in one pass over documents of
+        the given lengths, in any order: samples or packed windows, or the
+        batches batch_by_tokens makes of them when batching by max_tokens.
+        Packing assumes every document starts with sep_token_id, as the
+        documents of tokenizers trained by train_tokenizer.py do.
+
+        Args:
+            lengths (ndarray): Number of tokens of every document.
+        """
+        lengths = lengths[lengths > 0]
+        if self.packing:
+            # Full windows, plus the padded leftover of the stream
+            window_len = self.seq_len + 1
+            num_windows, leftover = divmod(int(lengths.sum()), window_len)
+            lengths = np.full(num_windows + (leftover > 0), window_len)
+            if leftover > 0:
+                lengths[-1] = leftover
+        if not self.max_tokens:
+            return len(lengths)
+
+        # Every length bucket yields its full batches plus one partial batch
+        bucket_width = -(-self.seq_len // self.num_length_buckets)
+        bucket_counts = np.bincount(
+            (np.minimum(lengths, self.seq_len) - 1) // bucket_width,
+            minlength=self.num_length_buckets)
+        bucket_lens = np.minimum(
+            np.arange(1, self.num_length_buckets + 1) * bucket_width,
+            self.seq_len)
+        batch_sizes = self.max_tokens // bucket_lens
+        return int((-(-bucket_counts // batch_sizes)).sum())
+
+    def item_counts(self, total_processes: int, epoch: int=None) -> list:
+        """
+        Exact number of items each process yields in one pass over its
+        documents in an epoch, or None if the document lengths are unknown.
+
+        Args:
+            total_processes (int): Number of workers across all ranks.
+            epoch (int): Epoch whose shard order gives the documents of every
+                process; defaults to the current one.
+        """
+        if self.shard_lengths is None:
+            return None
+        epoch = self.epoch if epoch is None else epoch
+        key = (epoch, total_processes)
+        if key not in self.counts_cache:
+            # Same document ranges as iter_documents
+            lengths = np.concatenate([self.shard_lengths[i]
+                                      for i in self.shard_permutation(epoch)])
+            bounds = [self.num_documents * i // total_processes
+                      for i in range(total_processes + 1)]
+            # Keep the first epoch's counts, which num_items needs every epoch
+            self.counts_cache = {cached_key: counts for cached_key, counts
+                                 in self.counts_cache.items()
+                                 if cached_key[0] == 0}
+            self.counts_cache[key] = [
+                self.count_items(lengths[start:stop])
+                for start, stop in zip(bounds[:-1], bounds[1:])]
+        return self.counts_cache[key]
+
+    def num_items(self, total_processes: int) -> int:
+        """
+        Number of items every process yields per epoch: the most any process
+        has in the first epoch, or an estimate when the document lengths are
+        unknown. It's the same for every epoch, since Lightning only reads the
+        length of the dataloader once.
+
+        Args:
+            total_processes (int): Number of workers across all ranks.
+        """
+        counts = self.item_counts(total_processes, epoch=0)
+        if counts is None:
+            return self.length // total_processes
+        return max(counts)
 
     def __len__(self):
         """
-        Calculate the length of the dataset for each worker.
+        Calculate the length of the dataset for each worker. When batching by
+        max_tokens, this is the number of batches.
         """
         worker_info = get_worker_info()
         num_workers = worker_info.num_workers if worker_info is not None else 1
         world_size = get_world_size()
         total_processes = num_workers * world_size
-        return (self.length // total_processes)
+        return self.num_items(total_processes)
+
+    def shard_order(self):
+        """
+        Returns the shards in the order they are read this epoch. When
+        shuffling, every process draws the same permutation, so the document
+        ranges of the processes still cover each document exactly once. The
+        permutation is seeded by the epoch even without a random seed, since
+        the processes have to agree on it.
+        """
+        return [self.shards[i] for i in self.shard_permutation()]
+
+    def shard_permutation(self, epoch: int=None) -> np.ndarray:
+        """ Indices of the shards in the order they are read in an epoch.
+        Args:
+            epoch (int): Epoch to order the shards for; defaults to the
+                current one.
+        """
+        if self.shuffle_buffer_size == 0:
+            return np.arange(len(self.shards))
+        epoch = self.epoch if epoch is None else epoch
+        rng = np.random.default_rng(
+            epoch if self.rand_seed is None else [self.rand_seed, epoch])
+        return rng.permutation(len(self.shards))
+
+    def sample_batches(self, token_budget: int, batch_size: int) -> list:
+        """
+        Draw a fixed random subset of the documents, seeded by rand_seed, whose
+        samples hold at most token_budget tokens, and collate it into batches.
+        Every document gets a random priority and the lowest-priority
+        documents that fit in the budget are kept, so the subset is uniform
+        over documents; the split is read once.
+
+        Args:
+            token_budget (int): Maximum number of sample tokens to keep.
+            batch_size (int): Number of samples per batch.
+
+        Returns:
+            A list of WindowBatch objects.
+        """
+        rng = np.random.default_rng(self.rand_seed)
+
+        reservoir = []
+        num_tokens = 0
+        for index, document in enumerate(self.iter_documents(0, 1)):
+            if len(document) == 0:
+                continue
+            # Without packing, only the truncated sample is kept
+            sample_tokens = len(document) if self.packing else \
+                min(len(document), self.seq_len + 1)
+            # Max-heap on priority, so the worst kept document is on top
+            heapq.heappush(reservoir, (-rng.random(), index, sample_tokens,
+                                       np.array(document)))
+            num_tokens += sample_tokens
+            while num_tokens > token_budget:
+                _, _, sample_tokens, _ = heapq.heappop(reservoir)
+                num_tokens -= sample_tokens
+
+        # Keep the documents in on-disk order
+        documents = [document for _, _, _, document in
+                     sorted(reservoir, key=lambda item: item[1])]
+        if self.packing:
+            samples = list(self.pack_documents(documents))
+        else:
+            samples = list(self.truncate_documents(documents))
+        batches = [self.pad_to_longest(samples[i:i + batch_size])
+                   for i in range(0, len(samples), batch_size)]
+
+        print(f"Validation subset: {len(documents):,} documents, " + \
+            f"{num_tokens:,} tokens, {len(batches):,} batches")
+        return batches
+
+    def iter_documents(self, process_id, total_processes):
+        """
+        Yields the token ids of every document assigned to this process, as
+        NumPy arrays. Each process owns one contiguous, equally sized range of
+        documents (in the epoch's shard order) and only reads the shards (and,
+        for parquet, the row groups) that overlap it.
+
+        Args:
+            process_id (int): Index of this worker across all ranks.
+            total_processes (int): Number of workers across all ranks.
+        """
+        start = self.num_documents * process_id // total_processes
+        stop = self.num_documents * (process_id + 1) // total_processes
+
+        shard_start = 0
+        for shard in self.shard_order():
+            shard_stop = shard_start + len(shard)
+            if start < shard_stop and shard_start < stop:
+                for document in shard.iter_documents(
+                        max(start, shard_start) - shard_start,
+                        min(stop, shard_stop) - shard_start):
+                    yield document
+            shard_start = shard_stop
 
     def __iter__(self):
         """
@@ -121,37 +1053,262 @@ class DataSet(torch.utils.data.IterableDataset):
         world_size = get_world_size()
         process_rank = get_rank()
 
-        # Create iterator over rows
-        iterator = self.data.iterrows()
-
-        for index, item in enumerate(iterator):
-            if index % (num_workers * world_size) == (process_rank * num_workers + worker_id):
-                item = item[1].values[0].tolist()
-                if len(item) <= self.seq_len:
-                    length = len(item)
-                    item = item + [self.pad_token_id]
-                    x = item[:length]
-                    y_true = item[1:length+1]  
-                else:
-                    x = item[:self.seq_len]
-                    y_true = item[1:self.seq_len+1]
-                yield(x,y_true)
+        process_id = process_rank * num_workers + worker_id
+        total_processes = num_workers * world_size
+
+        # Position of this process in the epoch, attached to every batch so
+        # that DataModule can checkpoint it. The shuffling is seeded by the
+        # position's seed, so the epoch's items can be generated again.
+        self.position = {
+            "process_id": process_id,
+            "total_processes": total_processes,
+            "epoch": self.epoch,
+            "items": 0,
+            "seed": [self.rand_seed, self.epoch, process_id] \
+                if self.rand_seed is not None else \
+                [np.random.SeedSequence().entropy]}
+
+        # Pick up where a requeued job left off, by generating the items again
+        # and skipping those already yielded. Documents still buffered for
+        # shuffling, packing or batching are therefore neither lost nor
+        # repeated, at the cost of reading the skipped documents again.
+        if self.resume_positions:
+            saved_processes = {position["total_processes"]
+                               for position in self.resume_positions.values()}
+            if saved_processes != {total_processes}:
+                print("Warning: Number of dataloader processes changed " + \
+                    f"from {max(saved_processes)} to {total_processes}; " + \
+                    "restarting the epoch's data.")
+            elif process_id not in self.resume_positions:
+                raise ValueError(
+                    f"The dataloader state has no position for process " + \
+                    f"{process_id} of {total_processes}; it can't be resumed.")
+            else:
+                resume_position = self.resume_positions[process_id]
+                if resume_position["epoch"] == self.epoch and \
+                        resume_position["items"] > 0:
+                    self.position.update(resume_position)
+        first_item = self.position["items"]
+
+        # Every process yields exactly the same number of items, so no DDP
+        # rank is left waiting on another one that has extra batches. Samples,
+        # packed windows and token-budget batches vary in number between
+        # processes, so processes with fewer than the most catch up: batching
+        # by max_tokens, they split some of their batches in two; otherwise,
+        # they start over on their own documents for the missing items. The
+        # number is that of the first epoch; in later epochs, and with unknown
+        # document lengths, processes also drop the items past it.
+        num_items = self.num_items(total_processes)
+        counts = self.item_counts(total_processes)
+        num_splits = 0
+        if counts is not None and self.max_tokens:
+            num_splits = max(num_items - counts[process_id], 0)
+
+        num_yielded = 0
+        for num_passes in itertools.count():
+            yielded_before = num_yielded
+            rng = np.random.default_rng(self.position["seed"] + [num_passes])
+            for item in self.iter_items(process_id, total_processes, rng,
+                                        num_splits if num_passes == 0 else 0):
+                num_yielded += 1
+                if num_yielded > first_item:
+                    self.position["items"] = num_yielded
+                    yield item
+                if num_yielded == num_items:
+                    return
+            if num_yielded == yielded_before:
+                return
+
+    def iter_items(self, process_id, total_processes, rng, num_splits=0):
+        """
+        Yields one pass of samples, or batches of samples when batching by
+        max_tokens, over the documents assigned to this process.
+
+        Args:
+            process_id (int): Index of this worker across all ranks.
+            total_processes (int): Number of workers across all ranks.
+            rng (Generator): Random number generator used for shuffling.
+            num_splits (int): Number of batches to split in two, when
+                batching by max_tokens.
+        """
+        documents = self.iter_documents(process_id, total_processes)
+
+        if self.shuffle_buffer_size > 0:
+            documents = self.shuffle_documents(documents, rng)
+
+        if self.packing:
+            samples = self.pack_documents(documents)
+        else:
+            samples = self.truncate_documents(documents)
+
+        if self.max_tokens:
+            yield from self.batch_by_tokens(samples, rng, num_splits)
+        else:
+            yield from samples
+
+    def shuffle_documents(self, documents, rng):
+        """
+        Streaming shuffle: holds up to shuffle_buffer_size documents and, for
+        every document read, yields one drawn at random from the buffer. Along
+        with the shuffled shard order, this gives a near-random order without
+        a global shuffle of the corpus.
+
+        Args:
+            documents (Iterator[ndarray]): Documents in on-disk order.
+            rng (Generator): Random number generator to draw with.
+        """
+        buffer = []
+        for item in documents:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(item)
+                continue
+            index = rng.integers(len(buffer))
+            yield buffer[index]
+            buffer[index] = item
+
+        # Drain what is left in random order
+        for index in rng.permutation(len(buffer)):
+            yield buffer[index]
+
+    def truncate_documents(self, documents):
+        """
+        Yields one sample per document, truncating documents longer than
+        seq_len + 1 tokens. Samples are token windows holding both the inputs
+        and the shifted targets; windows of seq_len tokens or fewer are given
+        their trailing padding target by the collator.
+        """
+        for item in documents:
+            if len(item) == 0:
+                continue
+            yield item[:self.seq_len+1]
+
+    def pack_documents(self, documents):
+        """
+        Concatenates documents, separated by sep_token_id, into a single token
+        stream and cuts it into windows of seq_len + 1 tokens. Documents that
+        run past the end of a window carry over into the next one, so only the
+        final window of the stream needs any padding.
+        """
+        window_len = self.seq_len + 1
+        separator = np.array([self.sep_token_id])
+
+        pending = []
+        pending_len = 0
+        num_documents = 0
+        num_windows = 0
+        num_real_tokens = 0
+        try:
+            for item in documents:
+                if len(item) == 0:
+                    continue
+                num_documents += 1
+
+                # Tokenized documents normally already start with the separator
+                if item[0] != self.sep_token_id:
+                    pending.append(separator)
+                    pending_len += 1
+                pending.append(item)
+                pending_len += len(item)
+
+                if pending_len < window_len:
+                    continue
+
+                # Cut as many full windows as possible and carry over the rest
+                stream = np.concatenate(pending)
+                full_len = len(stream) - len(stream) % window_len
+                for window in stream[:full_len].reshape(-1, window_len):
+                    num_windows += 1
+                    num_real_tokens += window_len
+                    yield window
+                pending = [stream[full_len:]]
+                pending_len = len(pending[0])
+
+            # Pad the leftover tokens like any other short sample
+            if pending_len > 0:
+                stream = np.concatenate(pending)
+                num_windows += 1
+                num_real_tokens += pending_len
+                yield stream
+        finally:
+            # Report even when the caller stops early
+            if num_windows > 0:
+                efficiency = num_real_tokens / (num_windows * window_len)
+                print(f"Packed {num_documents} documents into " + \
+                    f"{num_windows} windows of {window_len} tokens " + \
+                    f"(packing efficiency: {efficiency:.2%})")
+
+    def batch_by_tokens(self, samples, rng, num_splits=0):
+        """
+        Groups samples into length buckets and yields batches (lists of
+        samples) whose padded size, batch size times the bucket's longest
+        sample length, stays within max_tokens. Short-sequence batches
+        therefore carry more samples. Finished batches wait in a bounded window
+        and are released in random order, so batches of different lengths stay
+        interleaved.
+
+        Args:
+            samples (Iterator): Token windows to batch.
+            rng (Generator): Random number generator used for shuffling.
+            num_splits (int): Number of released batches of two samples or
+                more to split in two halves, which stay within max_tokens.
+        """
+        bucket_width = -(-self.seq_len // self.num_length_buckets)
+        buckets = [[] for _ in range(self.num_length_buckets)]
+        ready_batches = []
+
+        def release(batch):
+            nonlocal num_splits
+            if num_splits > 0 and len(batch) > 1:
+                num_splits -= 1
+                return [batch[:len(batch) // 2], batch[len(batch) // 2:]]
+            return [batch]
+
+        for sample in samples:
+            input_len = min(len(sample), self.seq_len)
+            bucket_index = (input_len - 1) // bucket_width
+            bucket = buckets[bucket_index]
+            bucket.append(sample)
+
+            # Every sample in the bucket pads to at most the bucket's upper bound
+            bucket_len = min((bucket_index + 1) * bucket_width, self.seq_len)
+            if len(bucket) < self.max_tokens // bucket_len:
+                continue
+
+            ready_batches.append(bucket.copy())
+            bucket.clear()
+
+            if len(ready_batches) >= self.batch_shuffle_window:
+                yield from release(
+                    ready_batches.pop(rng.integers(len(ready_batches))))
+
+        # Flush partially filled buckets, then drain the window
+        ready_batches.extend(bucket for bucket in buckets if bucket)
+        for index in rng.permutation(len(ready_batches)):
+            yield from release(ready_batches[index])
 
     def pad_to_longest(self, batch):
         """
-        Collator function for padding sequences to longest in batch, during training
+        Collator function for padding sequences to longest in batch, during
+        training. All windows are written into one preallocated buffer; inputs
+        and targets are views of it shifted by one token. Packed windows also
+        get the document segment id of every token, counting the documents
+        that start in the window, so the models can keep documents from
+        attending to each other.
         """
-        x, y_true = zip(*batch)
+        lengths = np.fromiter(map(len, batch), dtype=np.int64, count=len(batch))
 
-        x_lengths = [len(line) for line in x]
-        max_x_length = max(x_lengths)
-        x_padded = [line + [self.pad_token_id] * (max_x_length - len(line)) for line in x]
+        # A window of seq_len tokens or fewer still needs a padding target
+        width = min(lengths.max() + 1, self.seq_len + 1)
 
-        y_true_lengths = [len(line) for line in y_true]
-        max_y_true_lengths = max(y_true_lengths)
-        y_true_padded = [line + [self.pad_token_id] * (max_y_true_lengths - len(line)) for line in y_true]
+        # Fill the padding and scatter every token into place in one operation
+        windows = np.full((len(batch), width), self.pad_token_id, dtype=np.int64)
+        windows[np.arange(width) < lengths[:, None]] = np.concatenate(batch)
 
-        x_padded = torch.tensor(x_padded)
-        y_true_padded = torch.tensor(y_true_padded)
+        segments = None
+        if self.packing:
+            # Every document starts with the separator
+            segments = torch.from_numpy(
+                np.cumsum(windows == self.sep_token_id, axis=1, dtype=np.int32))
 
-        return x_padded, y_true_padded
+        position = None if self.position is None else dict(self.position)
+        return WindowBatch(torch.from_numpy(windows), position, segments)
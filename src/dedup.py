@@ -0,0 +1,188 @@
+import dask
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Odd multiplier used to combine word hashes into shingle and band hashes
+HASH_PRIME = np.uint64(0x9E3779B97F4A7C15)
+
+# Maximum number of shingle x permutation hashes held per batch of documents
+MAX_BATCH_HASHES = 2**22
+
+def minhash_signatures(texts: pd.Series, num_perm: int, shingle_size: int,
+                       seed: int) -> np.ndarray:
+    """ Compute the MinHash signature of every document, over its shingles
+    of shingle_size consecutive words. Words are hashed with pandas' stable
+    hash, shingle hashes are combined from the word hashes, and each of the
+    num_perm permutations is a multiply-shift hash of the shingle hash.
+
+    Args:
+        texts (Series): Non-empty documents.
+        num_perm (int): Number of hash permutations.
+        shingle_size (int): Number of words per shingle.
+        seed (int): Seed for the permutations.
+
+    Returns:
+        A uint32 array of shape (len(texts), num_perm).
+    """
+    if len(texts) == 0:
+        return np.empty((0, num_perm), dtype=np.uint32)
+
+    words = texts.str.split()
+    num_words = words.map(len).to_numpy()
+    word_hashes = pd.util.hash_array(
+        np.array(words.explode().to_numpy(), dtype=object))
+
+    # Lay out each document's words followed by shingle_size - 1 zeros, so
+    # that shingles never span two documents and documents shorter than a
+    # shingle still get one (partial) shingle
+    padded_len = num_words + shingle_size - 1
+    starts = np.concatenate([[0], np.cumsum(padded_len)[:-1]])
+    flat = np.zeros(padded_len.sum(), dtype=np.uint64)
+    flat[np.repeat(starts - np.cumsum(np.r_[0, num_words[:-1]]), num_words)
+         + np.arange(num_words.sum())] = word_hashes
+
+    # Shingle hash of every window start, then keep each document's windows
+    powers = HASH_PRIME ** np.arange(shingle_size, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        windows = (sliding_window_view(flat, shingle_size) * powers).sum(axis=1)
+    num_shingles = np.maximum(num_words - shingle_size + 1, 1)
+    shingles = windows[np.repeat(starts, num_shingles) + np.arange(
+        num_shingles.sum()) - np.repeat(
+            np.cumsum(np.r_[0, num_shingles[:-1]]), num_shingles)]
+    shingle_offsets = np.concatenate([[0], np.cumsum(num_shingles)])
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2**63, num_perm, dtype=np.uint64) * 2 + 1
+    b = rng.integers(0, 2**63, num_perm, dtype=np.uint64)
+
+    # Hash and take the minimum per document in batches of documents, to
+    # bound memory
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint32)
+    batch_shingles = max(1, MAX_BATCH_HASHES // num_perm)
+    doc = 0
+    while doc < len(texts):
+        stop = np.searchsorted(
+            shingle_offsets, shingle_offsets[doc] + batch_shingles,
+            side="right") - 1
+        stop = min(max(stop, doc + 1), len(texts))
+        batch = shingles[shingle_offsets[doc]:shingle_offsets[stop]]
+        with np.errstate(over="ignore"):
+            hashes = ((batch[:, None] * a + b) >> np.uint64(32)) \
+                .astype(np.uint32)
+        signatures[doc:stop] = np.minimum.reduceat(
+            hashes, shingle_offsets[doc:stop] - shingle_offsets[doc], axis=0)
+        doc = stop
+
+    return signatures
+
+def partition_keys(partition: pd.DataFrame, index: int, config) -> pd.DataFrame:
+    """ Compute the deduplication keys of every row of one partition: the
+    hash of its exact text, and one LSH key per band of its MinHash
+    signature. Rows sharing any key are duplicates of each other.
+
+    Args:
+        partition (DataFrame): Filtered partition of the dataset.
+        index (int): Index of the partition.
+        config (Struct): A Struct object with all configuration fields.
+
+    Returns:
+        A DataFrame with one row per key: the row's global id, the key, whether
+        it is an exact key, and the row's number of words.
+    """
+    texts = partition[config.dataset_feature]
+    ids = (np.uint64(index) << np.uint64(32)) + \
+        np.arange(len(texts), dtype=np.uint64)
+    num_words = texts.str.split().map(len).to_numpy()
+
+    # Band keys hash the signature rows of each band together with the band
+    # number, so keys of different bands don't collide
+    signatures = minhash_signatures(
+        texts, config.minhash_num_perm, config.shingle_size,
+        config.rand_seed or 0)
+    rows_per_band = config.minhash_num_perm // config.minhash_bands
+    bands = signatures.reshape(len(texts), config.minhash_bands, rows_per_band)
+    powers = HASH_PRIME ** np.arange(1, rows_per_band + 1, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        band_keys = (bands.astype(np.uint64) * powers).sum(axis=2) + \
+            np.arange(config.minhash_bands, dtype=np.uint64)
+    exact_keys = pd.util.hash_pandas_object(texts, index=False).to_numpy()
+
+    num_keys = config.minhash_bands + 1
+    return pd.DataFrame({
+        "id": np.repeat(ids, num_keys),
+        "key": np.column_stack([exact_keys, band_keys]).ravel(),
+        "exact": np.tile(np.arange(num_keys) == 0, len(texts)),
+        "words": np.repeat(num_words, num_keys)})
+
+def find_duplicates(partitions: list, config) -> tuple:
+    """ Find exact and near-duplicate rows across the whole dataset. Keys are
+    computed in parallel per partition, then grouped with a Dask shuffle, and
+    the ids of the rows to remove are shuffled back to the partitions they
+    come from, so memory stays bounded by the partition size. Of every group
+    of rows that share a key, the row with the lowest id is kept. Nothing is
+    computed here, so the caller can compute the removal together with the
+    partitions that use it.
+
+    Args:
+        partitions (List[Delayed]): Filtered partitions of the dataset.
+        config (Struct): A Struct object with all configuration fields.
+
+    Returns:
+        One Delayed per partition, of the sorted ids of its rows to remove,
+        and a Delayed dict with the number of exact and near-duplicate rows
+        and the number of words removed.
+    """
+    assert config.minhash_num_perm % config.minhash_bands == 0, \
+        f"minhash_bands ({config.minhash_bands}) must divide " + \
+        f"minhash_num_perm ({config.minhash_num_perm})."
+
+    meta = pd.DataFrame({
+        "id": pd.Series(dtype=np.uint64),
+        "key": pd.Series(dtype=np.uint64),
+        "exact": pd.Series(dtype=bool),
+        "words": pd.Series(dtype=np.int64)})
+    keys = dd.from_delayed(
+        [dask.delayed(partition_keys)(partition, i, config)
+         for i, partition in enumerate(partitions)],
+        meta=meta)
+
+    # A row is a duplicate if another row with the same key has a lower id
+    first_ids = keys.groupby("key")["id"] \
+        .min(split_out=keys.npartitions).rename("first_id")
+    keys = keys.merge(first_ids.to_frame(), left_on="key", right_index=True)
+    duplicates = keys[keys["id"] != keys["first_id"]][["id", "exact", "words"]]
+
+    # One row per removed id, instead of one per key it shares
+    removed = duplicates.groupby("id").max(split_out=keys.npartitions)
+
+    # Ids start with the index of their partition, so these divisions put
+    # the ids of every partition in the partition of the same index
+    divisions = [i << 32 for i in range(len(partitions))] + \
+        [(len(partitions) << 32) - 1]
+    removed = removed.reset_index().set_index("id", divisions=divisions)
+    removed_ids = [dask.delayed(np.asarray)(partition.index)
+                   for partition in removed.to_delayed()]
+
+    num_exact = removed["exact"].sum()
+    report = dask.delayed(dict)(
+        exact=num_exact,
+        near=removed["words"].count() - num_exact,
+        words=removed["words"].sum())
+
+    return removed_ids, report
+
+def keep_mask(removed_ids: np.ndarray, index: int, num_rows: int) -> np.ndarray:
+    """ Mask of the rows of one partition that are not duplicates.
+    Args:
+        removed_ids (ndarray): Sorted ids of the partition's rows to remove.
+        index (int): Index of the partition.
+        num_rows (int): Number of rows in the filtered partition.
+    """
+    start = np.uint64(index) << np.uint64(32)
+    first, last = np.searchsorted(removed_ids, [start, start + np.uint64(num_rows)])
+    mask = np.ones(num_rows, dtype=bool)
+    mask[(removed_ids[first:last] - start).astype(np.int64)] = False
+    return mask
@@ -1,6 +1,13 @@
 import dask
 dask.config.set({"dataframe.query-planning": True})
 import dask.dataframe as dd
+from dask.diagnostics import ProgressBar
+import io
+import itertools
+import os
+import pyarrow as pa
+import pyarrow.json as pj
+import pyarrow.parquet as pq
 import sys
 import yaml
 
@@ -9,6 +16,113 @@ from pathlib import Path
 from utils import Struct
 
 
+# Compressions pyarrow can decompress while streaming, by file extension
+COMPRESSION_SUFFIXES = [".zst", ".gz", ".bz2", ".lz4"]
+
+def local_file_stem(path: Path) -> str:
+    """ Name of a local dump file without its format and compression
+    extensions, e.g. 'c4-train.00000' for 'c4-train.00000.jsonl.zst'.
+    Returns None if the file isn't a JSONL or parquet file.
+    Args:
+        path (Path): Path of the local file.
+    """
+    name = path.name
+    for suffix in COMPRESSION_SUFFIXES:
+        name = name.removesuffix(suffix)
+    for suffix in [".jsonl", ".json", ".parquet"]:
+        if name.endswith(suffix):
+            return name.removesuffix(suffix)
+    return None
+
+def iter_local_batches(path: Path, feature: str, batch_size: int):
+    """ Yields the text column of a local JSONL (optionally compressed) or
+    parquet file as pyarrow tables of up to batch_size rows, streaming and
+    decompressing the file so only one batch is in memory at a time.
+    Args:
+        path (Path): Path of the local file.
+        feature (str): Field holding the text.
+        batch_size (int): Number of rows per batch.
+    """
+    if path.name.endswith(".parquet"):
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=batch_size,
+                                               columns=[feature]):
+            yield pa.Table.from_batches([batch])
+        return
+
+    # Only the text field is parsed; all other fields are ignored
+    parse_options = pj.ParseOptions(
+        explicit_schema=pa.schema([(feature, pa.string())]),
+        unexpected_field_behavior="ignore")
+    with pa.input_stream(path, compression="detect") as stream:
+        lines = io.BufferedReader(stream)
+        while True:
+            batch = list(itertools.islice(lines, batch_size))
+            if not batch:
+                break
+            yield pj.read_json(io.BytesIO(b"".join(batch)),
+                               parse_options=parse_options)
+
+def ingest_file(path: Path, output_path: Path, feature: str,
+                row_group_size: int) -> int:
+    """ Normalize one local dump file into a parquet file with only the text
+    column, in row groups of row_group_size rows. The file is written under
+    a temporary name and only renamed once complete, so an interrupted
+    ingestion leaves no partial output behind.
+    Args:
+        path (Path): Path of the local file.
+        output_path (Path): Path of the parquet file to write.
+        feature (str): Field holding the text.
+        row_group_size (int): Number of rows per parquet row group.
+
+    Returns:
+        The number of rows written.
+    """
+    num_rows = 0
+    schema = pa.schema([(feature, pa.string())])
+    with pq.ParquetWriter(f"{output_path}.tmp", schema) as writer:
+        for batch in iter_local_batches(path, feature, row_group_size):
+            writer.write_table(batch.select([feature]).cast(schema),
+                               row_group_size=row_group_size)
+            num_rows += batch.num_rows
+    os.replace(f"{output_path}.tmp", output_path)
+    return num_rows
+
+def ingest_local_data(config):
+    """
+    Ingest local JSONL (optionally zstd/gzip/bz2/lz4 compressed) or parquet
+    dumps into the raw parquet layout split_data.py reads. Files are
+    decompressed and converted in parallel processes, and files that were
+    already converted are skipped, so an interrupted run can be resumed.
+    """
+    dataset_dir = Path(config.raw_dataset_path)
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+
+    local_paths = sorted(path for path in Path(config.local_dataset_path).iterdir()
+                         if local_file_stem(path) is not None)
+    stems = [local_file_stem(path) for path in local_paths]
+    assert len(set(stems)) == len(stems), \
+        "Local files must have distinct names without their extensions."
+
+    print(f"Ingesting {len(local_paths)} files from {config.local_dataset_path}")
+    print(f"File path: {dataset_dir}")
+
+    # Resume: skip files whose output was completed by an earlier run
+    ingest_files = [
+        dask.delayed(ingest_file)(
+            path, dataset_dir / f"{stem}.parquet", config.dataset_feature,
+            config.ingest_row_group_size)
+        for path, stem in zip(local_paths, stems)
+        if not (dataset_dir / f"{stem}.parquet").exists()]
+    print(f"Skipping {len(local_paths) - len(ingest_files)} files " + \
+        "already ingested")
+
+    num_rows = sum(dask.compute(*ingest_files,
+                                scheduler="processes",
+                                num_workers=config.num_proc))
+    print(f"Ingestion completed: {num_rows} rows written.")
+
+
 def download_data(config):
     """ 
     Download dataset from Hugging Face through the 
@@ -47,6 +161,8 @@ def download_data(config):
 
 
 if __name__ == "__main__":
+    ProgressBar().register()
+
     args = sys.argv
     config_path = args[1]
 
@@ -55,4 +171,7 @@ if __name__ == "__main__":
 
     config = Struct(**config)
 
-    download_data(config)
+    if config.local_dataset_path is not None:
+        ingest_local_data(config)
+    else:
+        download_data(config)
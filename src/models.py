@@ -37,6 +37,8 @@ class RetNetModel(LightningModule):
             activation_dropout=config.activation_dropout,
             vocab_size=config.vocab_size,
             max_seq_len=config.seq_len,
+            recurrent_chunk_scan=config.recurrent_chunk_scan,
+            parallel_block_size=config.retention_block_size,
             lr=config.learning_rate)
 
         self.model_hf = RetNetModelHF(hf_config)
@@ -45,26 +47,44 @@ class RetNetModel(LightningModule):
 
         self.save_hyperparameters(self.model_hf.get_params())
 
-    def forward(self, x: Tensor) -> Tensor:
+    def forward(self, x: Tensor, segment_ids: Optional[Tensor]=None) -> Tensor:
         """
         Args:
             x (Tensor): Long tensor of dimensions: (batch size, sequence
                 length).
+            segment_ids (Tensor): Optional tensor of the same dimensions with
+                the document segment id of every token of packed sequences.
+                Tokens only attend to tokens of their own segment.
 
         Returns:
             A tensor of dimensions: (batch size, sequence length, vocabulary
                 size).
         """
-        preds = self.model_hf(x)
+        preds = self.model_hf(x, segment_ids=segment_ids)
         return preds
 
+    def init_incremental_state(self, batch_size: int,
+                               device: Optional[torch.device]=None) -> dict:
+        """ See RetNetModelHF.init_incremental_state. """
+        return self.model_hf.init_incremental_state(batch_size, device)
+
+    def prefill(self, tokens: Tensor, incremental_state: dict) -> Tensor:
+        """ See RetNetModelHF.prefill. """
+        return self.model_hf.prefill(tokens, incremental_state)
+
+    def decode_step(self, tokens: Tensor, incremental_state: dict,
+                    project: bool=True) -> Optional[Tensor]:
+        """ See RetNetModelHF.decode_step. """
+        return self.model_hf.decode_step(tokens, incremental_state, project)
+
     def training_step(self, batch: Tensor, batch_idx: int):
         """ Training step, called automatically by PyTorch Lightning. """
-        # Unpack batch
+        # Unpack batch; packed batches also carry document segment ids
         inputs, targets = batch
+        segment_ids = getattr(batch, "segment_ids", None)
 
         # Get predictions
-        preds = self.model_hf(inputs)
+        preds = self.model_hf(inputs, segment_ids=segment_ids)
 
         # Reshape the model predictions for Cross Entropy
         preds = preds.transpose(-2, -1)
@@ -86,11 +106,12 @@ class RetNetModel(LightningModule):
 
     def validation_step(self, batch: Tensor, batch_idx: int):
         """ Validation step, called automatically by PyTorch Lightning. """
-        # Unpack batch
+        # Unpack batch; packed batches also carry document segment ids
         inputs, targets = batch
+        segment_ids = getattr(batch, "segment_ids", None)
 
         # Get predictions
-        preds = self.model_hf(inputs)
+        preds = self.model_hf(inputs, segment_ids=segment_ids)
 
         # Reshape the model predictions for Cross Entropy
         preds = preds.transpose(-2, -1)
@@ -124,11 +145,12 @@ class RetNetModel(LightningModule):
 
     def test_step(self, batch: Tensor, batch_idx: int):
         """ Test step, called automatically by PyTorch Lightning. """
-        # Unpack batch
+        # Unpack batch; packed batches also carry document segment ids
         inputs, targets = batch
+        segment_ids = getattr(batch, "segment_ids", None)
 
         # Get predictions
-        preds = self.model_hf(inputs)
+        preds = self.model_hf(inputs, segment_ids=segment_ids)
 
         # Reshape the model predictions for Cross Entropy
         preds = preds.transpose(-2, -1)
@@ -198,25 +220,29 @@ class TransformerModel(LightningModule):
 
         self.save_hyperparameters(self.model_hf.get_params())
 
-    def forward(self, x: Tensor) -> Tensor:
+    def forward(self, x: Tensor, segment_ids: Optional[Tensor]=None) -> Tensor:
         """
         Args:
             x (Tensor): Long tensor of dimensions: (batch size, sequence
                 length).
+            segment_ids (Tensor): Optional tensor of the same dimensions with
+                the document segment id of every token of packed sequences.
+                Tokens only attend to tokens of their own segment.
 
         Returns:
             A tensor of dimensions: (batch size, sequence length, vocabulary
                 size).
         """
-        preds = self.model_hf(x)
+        preds = self.model_hf(x, segment_ids=segment_ids)
         return preds
 
     def training_step(self, batch: Tensor, batch_idx: int):
         """ Training step, called automatically by PyTorch Lightning. """
-        # Unpack batch
+        # Unpack batch; packed batches also carry document segment ids
         inputs, targets = batch
+        segment_ids = getattr(batch, "segment_ids", None)
 
-        preds = self.model_hf(inputs)
+        preds = self.model_hf(inputs, segment_ids=segment_ids)
 
         # Reshape the model predictions for Cross Entropy
         preds = preds.transpose(-2, -1)
@@ -238,10 +264,11 @@ class TransformerModel(LightningModule):
 
     def validation_step(self, batch: Tensor, batch_idx: int):
         """ Validation step, called automatically by PyTorch Lightning. """
-        # Unpack batch
+        # Unpack batch; packed batches also carry document segment ids
         inputs, targets = batch
+        segment_ids = getattr(batch, "segment_ids", None)
 
-        preds = self.model_hf(inputs)
+        preds = self.model_hf(inputs, segment_ids=segment_ids)
 
         # Reshape the model predictions for Cross Entropy
         preds = preds.transpose(-2, -1)
@@ -275,10 +302,11 @@ class TransformerModel(LightningModule):
 
     def test_step(self, batch: Tensor, batch_idx: int):
         """ Test step, called automatically by PyTorch Lightning. """
-        # Unpack batch
+        # Unpack batch; packed batches also carry document segment ids
         inputs, targets = batch
+        segment_ids = getattr(batch, "segment_ids", None)
 
-        preds = self.model_hf(inputs)
+        preds = self.model_hf(inputs, segment_ids=segment_ids)
 
         # Reshape the model predictions for Cross Entropy
         preds = preds.transpose(-2, -1)
@@ -355,25 +383,29 @@ class LongNetModel(LightningModule):
 
         self.save_hyperparameters(self.model_hf.get_params())
 
-    def forward(self, x: Tensor) -> Tensor:
+    def forward(self, x: Tensor, segment_ids: Optional[Tensor]=None) -> Tensor:
         """
         Args:
             x (Tensor): Long tensor of dimensions: (batch size, sequence
                 length).
+            segment_ids (Tensor): Optional tensor of the same dimensions with
+                the document segment id of every token of packed sequences,
+                which LongNet does not support.
 
         Returns:
             A tensor of dimensions: (batch size, sequence length, vocabulary
                 size).
         """
-        preds = self.model_hf(x)
+        preds = self.model_hf(x, segment_ids=segment_ids)
         return preds
 
     def training_step(self, batch: Tensor, batch_idx: int):
         """ Training step, called automatically by PyTorch Lightning. """
-        # Unpack batch
+        # Unpack batch; packed batches also carry document segment ids
         inputs, targets = batch
+        segment_ids = getattr(batch, "segment_ids", None)
 
-        preds = self.model_hf(inputs)
+        preds = self.model_hf(inputs, segment_ids=segment_ids)
 
         # Reshape the model predictions for Cross Entropy
         preds = preds.transpose(-2, -1)
@@ -395,10 +427,11 @@ class LongNetModel(LightningModule):
 
     def validation_step(self, batch: Tensor, batch_idx: int):
         """ Validation step, called automatically by PyTorch Lightning. """
-        # Unpack batch
+        # Unpack batch; packed batches also carry document segment ids
         inputs, targets = batch
+        segment_ids = getattr(batch, "segment_ids", None)
 
-        preds = self.model_hf(inputs)
+        preds = self.model_hf(inputs, segment_ids=segment_ids)
 
         # Reshape the model predictions for Cross Entropy
         preds = preds.transpose(-2, -1)
@@ -420,10 +453,11 @@ class LongNetModel(LightningModule):
 
     def test_step(self, batch: Tensor, batch_idx: int):
         """ Test step, called automatically by PyTorch Lightning. """
-        # Unpack batch
+        # Unpack batch; packed batches also carry document segment ids
         inputs, targets = batch
+        segment_ids = getattr(batch, "segment_ids", None)
 
-        preds = self.model_hf(inputs)
+        preds = self.model_hf(inputs, segment_ids=segment_ids)
 
         # Reshape the model predictions for Cross Entropy
         preds = preds.transpose(-2, -1)
@@ -492,19 +526,89 @@ class RetNetModelHF(PreTrainedModel):
             self.config,
             embed_tokens=text_embeddings)
 
-    def forward(self, x: Tensor) -> Tensor:
+    def forward(self, x: Tensor, segment_ids: Optional[Tensor]=None) -> Tensor:
         """
         Args:
             x (Tensor): Long tensor of dimensions: (batch size, sequence
                 length).
+            segment_ids (Tensor): Optional tensor of the same dimensions with
+                the document segment id of every token of packed sequences.
+                Tokens only attend to tokens of their own segment.
 
         Returns:
             A tensor of dimensions: (batch size, sequence length, vocabulary
                 size).
         """
-        preds, _ = self.decoder_stack(x)
+        preds, _ = self.decoder_stack(x, segment_ids=segment_ids)
         return preds
 
+    def init_incremental_state(self, batch_size: int,
+                               device: Optional[torch.device]=None) -> dict:
+        """ Preallocate the recurrent state of every retention layer for
+        decoding one token at a time; decode_step updates it in place.
+        Args:
+            batch_size (int): Number of sequences decoded together.
+            device (torch.device): Device of the state; defaults to the
+                model's device.
+
+        Returns:
+            The state, to pass to every decode_step call.
+        """
+        weight = self.decoder_stack.embed_tokens.weight
+        return self.decoder_stack.init_incremental_state(
+            batch_size,
+            device=weight.device if device is None else device,
+            dtype=weight.dtype)
+
+    def prefill(self, tokens: Tensor, incremental_state: dict) -> Tensor:
+        """ Read a whole prompt with the chunkwise form of RetNet, whose cost
+        grows linearly with the prompt length, and leave the recurrent state
+        ready for decode_step. Up to one chunk, the logits and state are those
+        of decoding the prompt token by token. Past one chunk, the chunkwise
+        form normalizes its outputs differently before the group norm, so the
+        returned logits and the states of layers after the first are close to,
+        but not exactly, those; see tests/test_recurrent_decoding.py for the
+        tolerances.
+        Args:
+            tokens (Tensor): Long tensor of dimensions: (batch size, prompt
+                length).
+            incremental_state (dict): State from init_incremental_state; it
+                is overwritten.
+
+        Returns:
+            A tensor of dimensions: (batch size, vocabulary size) with the
+                logits of the token after the prompt.
+        """
+        incremental_state["is_first_step"] = True
+        features, _ = self.decoder_stack(
+            tokens, incremental_state=incremental_state, features_only=True)
+        # Only the last position goes through the output projection
+        return self.decoder_stack.output_layer(features[:, -1])
+
+    def decode_step(self, tokens: Tensor, incremental_state: dict,
+                    project: bool=True) -> Optional[Tensor]:
+        """ Feed the last token of each sequence through the recurrent form of
+        RetNet, whose cost per token doesn't depend on the context length.
+        Args:
+            tokens (Tensor): Long tensor of dimensions: (batch size, number
+                of tokens decoded so far, including this one). Only the last
+                token is read; the length gives its position.
+            incremental_state (dict): State from init_incremental_state or
+                prefill, holding all earlier tokens.
+            project (bool): Whether to compute the logits; prompt tokens
+                before the last one don't need them.
+
+        Returns:
+            A tensor of dimensions: (batch size, vocabulary size) with the
+                logits of the next token, or None if project is False.
+        """
+        features, _ = self.decoder_stack(
+            tokens, incremental_state=incremental_state, features_only=True)
+        if not project:
+            return None
+        # Only the last position goes through the output projection
+        return self.decoder_stack.output_layer(features[:, -1])
+
     def get_params(self) -> dict:
         """ Get model parameters dictionary. """
         allowed_types = (int, float, str, bool, Tensor)
@@ -542,17 +646,20 @@ class TransformerModelHF(PreTrainedModel):
 
         self.decoder_stack = Decoder(self.config, embed_tokens=text_embeddings)
 
-    def forward(self, x: Tensor) -> Tensor:
+    def forward(self, x: Tensor, segment_ids: Optional[Tensor]=None) -> Tensor:
         """
         Args:
             x (Tensor): Long tensor of dimensions: (batch size, sequence
                 length).
+            segment_ids (Tensor): Optional tensor of the same dimensions with
+                the document segment id of every token of packed sequences.
+                Tokens only attend to tokens of their own segment.
 
         Returns:
             A tensor of dimensions: (batch size, sequence length, vocabulary
                 size).
         """
-        preds, _ = self.decoder_stack(x)
+        preds, _ = self.decoder_stack(x, segment_ids=segment_ids)
         return preds
 
     def get_params(self) -> dict:
@@ -593,16 +700,22 @@ class LongNetModelHF(PreTrainedModel):
 
         self.decoder_stack = LongNetDecoder(self.config, embed_tokens=text_embeddings)
 
-    def forward(self, x: Tensor) -> Tensor:
+    def forward(self, x: Tensor, segment_ids: Optional[Tensor]=None) -> Tensor:
         """
         Args:
             x (Tensor): Long tensor of dimensions: (batch size, sequence
                 length).
+            segment_ids (Tensor): Optional tensor of the same dimensions with
+                the document segment id of every token of packed sequences.
+                Dilated attention can't keep documents apart, so packed
+                sequences are rejected rather than attending across documents.
 
         Returns:
             A tensor of dimensions: (batch size, sequence length, vocabulary
                 size).
         """
+        if segment_ids is not None:
+            raise ValueError("Document segments (packing) not supported by LongNet!")
         preds, _ = self.decoder_stack(x)
         return preds
 
@@ -1,20 +1,89 @@
 import datasets
+import numpy as np
+import pandas as pd
 import sys
 import time
 import yaml
 
 from datasets import DatasetDict
+from dedup import find_duplicates, keep_mask
 from pathlib import Path
 from utils import Struct
 
 import dask
 dask.config.set({'dataframe.query-planning': True})
 import dask.dataframe as dd
-import dask_ml
+
+SPLIT_NAMES = ["train", "validation", "test"]
+
+def assign_splits(texts: pd.Series, splits: list, rand_seed: int) -> np.ndarray:
+    """ Assign every row to a split by a stable hash of its text, so the
+    assignment is pseudo-random but the same on every run (and identical
+    texts always land in the same split).
+
+    Args:
+        texts (Series): Text of each row.
+        splits (List[float]): Fractions of rows for each split.
+        rand_seed (int): Seed mixed into the hash.
+
+    Returns:
+        The index of the split of each row.
+    """
+    hash_key = f"{rand_seed or 0:016d}"[-16:]
+    hashes = pd.util.hash_pandas_object(
+        texts, index=False, hash_key=hash_key).to_numpy()
+
+    # Map the 64-bit hash to [0, 1) and bucket it by the cumulative fractions
+    position = hashes / 2**64
+    boundaries = np.cumsum(splits) / np.sum(splits)
+    return np.minimum(np.searchsorted(boundaries, position, side="right"),
+                      len(splits) - 1)
+
+def filter_partition(partition: pd.DataFrame, feature: str) -> pd.DataFrame:
+    """ Filter out rows with only whitespace.
+    Args:
+        partition (DataFrame): Partition of the dataset.
+        feature (str): Column of the partition holding the text.
+    """
+    texts = partition[feature]
+    return partition[texts.notna() & (texts.str.strip() != '')] \
+        .reset_index(drop=True)
+
+def split_partition(partition: pd.DataFrame, config, dataset_dir: Path,
+                    index: int, removed_ids: np.ndarray) -> list:
+    """ Write the rows of one filtered partition to each split.
+
+    Args:
+        partition (DataFrame): Filtered partition of the dataset.
+        config (Struct): A Struct object with all configuration fields.
+        dataset_dir (Path): Folder holding the dataset and its splits.
+        index (int): Index of the partition.
+        removed_ids (ndarray): Sorted ids of the partition's duplicate rows
+            to drop, or None.
+
+    Returns:
+        The number of rows written to each split.
+    """
+    if removed_ids is not None:
+        partition = partition[keep_mask(removed_ids, index, len(partition))]
+
+    split_ids = assign_splits(
+        partition[config.dataset_feature], config.splits, config.rand_seed)
+
+    num_rows = []
+    for i, name in enumerate(SPLIT_NAMES):
+        split = partition[split_ids == i]
+        split.to_parquet(dataset_dir / name / f"part.{index}.parquet",
+                         index=False)
+        num_rows.append(len(split))
+
+    return num_rows
 
 def split_data(config):
     """ 
     Filter and split the dataset into training, validation, and testing datasets.
+    Every row is read once and assigned to a split by the hash of its text,
+    and all three splits are written in the same pass.
     """
     # Create folder to save this dataset's files in
     dataset_dir = Path(config.raw_dataset_path)
@@ -25,24 +94,39 @@ def split_data(config):
     # Read the dataset from disk
     dataset = dd.read_parquet(dataset_dir / "*.parquet")
 
-    # Filter out rows with only whitespace
-    dataset = dataset[dataset[config.dataset_feature].str.strip() != '']
-
-    # Split into training, validation, and testing datasets
-    train, test_valid = dask_ml.model_selection.train_test_split(
-        dataset,
-        shuffle=False, # Very expensive for large datasets
-        train_size=config.splits[0],
-        random_state=config.rand_seed)
-    test, validation = dask_ml.model_selection.train_test_split(
-        test_valid,
-        shuffle=False,
-        train_size=config.splits[1] / (config.splits[1] + config.splits[2]),
-        random_state=config.rand_seed)
-
-    train.to_parquet(dataset_dir / 'train')
-    validation.to_parquet(dataset_dir / 'validation')
-    test.to_parquet(dataset_dir / 'test')
+    # Clear out splits from previous runs, which may have more partitions
+    for name in SPLIT_NAMES:
+        (dataset_dir / name).mkdir(exist_ok=True)
+        for path in (dataset_dir / name).glob("part.*.parquet"):
+            path.unlink()
+
+    partitions = [
+        dask.delayed(filter_partition)(partition, config.dataset_feature)
+        for partition in dataset.to_delayed()]
+
+    # Optionally find exact and near-duplicate rows
+    removed_ids = [None] * len(partitions)
+    report = None
+    if config.dedup:
+        print("Finding duplicates...")
+        removed_ids, report = find_duplicates(partitions, config)
+
+    # Split every partition in parallel, writing to all splits at once; the
+    # duplicates are found in the same pass
+    split_writes = [
+        dask.delayed(split_partition)(
+            partition, config, dataset_dir, i, partition_removed_ids)
+        for i, (partition, partition_removed_ids) in enumerate(
+            zip(partitions, removed_ids))]
+    *split_rows, report = dask.compute(*split_writes, report)
+    num_rows = np.sum(split_rows, axis=0)
+
+    if report is not None:
+        print(f"Removed {report['exact']} exact and {report['near']} " + \
+            f"near-duplicate rows ({report['words']} words)")
+
+    for name, rows in zip(SPLIT_NAMES, num_rows):
+        print(f"{name}: {rows} rows")
 
     print("Finished")
 
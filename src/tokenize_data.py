@@ -1,57 +1,337 @@
 import argparse
 import dask
-dask.config.set({'dataframe.query-planning': True})
-import dask.dataframe as dd
 from dask.diagnostics import ProgressBar
+import hashlib
+import itertools
+import json
+import numpy as np
+import os
 import pyarrow as pa
+import pyarrow.parquet as pq
+import time
 import yaml
 
+from functools import lru_cache
 from pathlib import Path
 from transformers import PreTrainedTokenizerFast
 from utils import Struct
 
-ProgressBar().register()
 
-def tokenize_data(config, split):
+def token_dtype(vocab_size: int) -> type:
+    """ Get the narrowest unsigned integer type that can hold every token id.
+    Args:
+        vocab_size (int): Number of tokens in the tokenizer's vocabulary.
+    """
+    if vocab_size <= np.iinfo(np.uint16).max + 1:
+        return np.uint16
+    return np.uint32
 
-    # Dataset path
-    dataset_path = Path(config.raw_dataset_path) / split / '*.parquet'
+@lru_cache
+def load_tokenizer(tokenizer_path: str) -> PreTrainedTokenizerFast:
+    """ Load a tokenizer once per process.
+    Args:
+        tokenizer_path (str): Path to the tokenizer folder.
+    """
+    return PreTrainedTokenizerFast.from_pretrained(tokenizer_path)
+
+def tokenizer_fingerprint(tokenizer: PreTrainedTokenizerFast) -> str:
+    """ Hash of everything that determines the tokenizer's output, i.e. its
+    full serialized state (vocabulary, merges, normalizer, post-processor).
+    Args:
+        tokenizer (PreTrainedTokenizerFast): Tokenizer to fingerprint.
+    """
+    return hashlib.sha256(
+        tokenizer.backend_tokenizer.to_str().encode()).hexdigest()
+
+def file_hash(path: Path) -> str:
+    """ SHA-256 hash of a file's contents, read in 1 MiB blocks.
+    Args:
+        path (Path): Path of the file to hash.
+    """
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def tokenize_partition(texts: list, tokenizer_path: str, dtype: type,
+                       batch_size: int):
+    """ Tokenize one partition of raw text in batches, using the Rust
+    tokenizer's batch encoding (which is multi-threaded), and gather the
+    token ids into one flat array plus an offsets index. Document i is
+    tokens[offsets[i]:offsets[i + 1]].
+
+    Args:
+        texts (List[str]): Documents of the partition.
+        tokenizer_path (str): Path to the tokenizer folder.
+        dtype (type): Integer type to store the tokens with.
+        batch_size (int): Number of documents encoded per batch.
+
+    Returns:
+        The flat token array and the int64 offsets index.
+    """
+    tokenizer = load_tokenizer(tokenizer_path).backend_tokenizer
+    # Documents are kept whole; padding/truncation happen in the dataloader
+    tokenizer.no_padding()
+    tokenizer.no_truncation()
+
+    lengths = np.zeros(len(texts), dtype=np.int64)
+    token_batches = []
+    for start in range(0, len(texts), batch_size):
+        encodings = tokenizer.encode_batch(texts[start:start + batch_size])
+        lengths[start:start + len(encodings)] = \
+            [len(encoding.ids) for encoding in encodings]
+        token_batches.append(np.fromiter(
+            itertools.chain.from_iterable(
+                encoding.ids for encoding in encodings),
+            dtype=dtype,
+            count=lengths[start:start + len(encodings)].sum()))
+
+    # Offsets index is the running total of document lengths
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tokens = np.concatenate(token_batches) if token_batches else \
+        np.empty(0, dtype=dtype)
+
+    return tokens, offsets
+
+def write_token_shard(tokens: np.ndarray, offsets: np.ndarray,
+                      shard_path: Path) -> int:
+    """ Write a tokenized partition as one flat token array plus an offsets
+    index, for the "memmap" format. Each file is written under a temporary
+    name first and then atomically replaces the previous version.
+
+    Args:
+        tokens (ndarray): Flat token ids of every document.
+        offsets (ndarray): Offsets index into tokens.
+        shard_path (Path): Path prefix for the shard's '.tokens.npy' and
+            '.offsets.npy' files.
+
+    Returns:
+        The number of bytes written.
+    """
+    for suffix, array in ((".offsets.npy", offsets), (".tokens.npy", tokens)):
+        path = f"{shard_path}{suffix}"
+        with open(f"{path}.tmp", "wb") as f:
+            np.save(f, array)
+        os.replace(f"{path}.tmp", path)
+
+    return tokens.nbytes + offsets.nbytes
+
+def write_parquet_shard(tokens: np.ndarray, offsets: np.ndarray,
+                        shard_path: Path, column: str,
+                        row_group_size: int) -> int:
+    """ Write a tokenized partition as a parquet file with one list of token
+    ids per row, for the "parquet" format, in row groups of row_group_size
+    rows. The file is written under a temporary name first and then
+    atomically replaces the previous version.
+
+    Args:
+        tokens (ndarray): Flat token ids of every document.
+        offsets (ndarray): Offsets index into tokens.
+        shard_path (Path): Path of the parquet file.
+        column (str): Name of the token list column.
+        row_group_size (int): Number of rows per parquet row group.
+
+    Returns:
+        The number of bytes written.
+    """
+    # 64-bit list offsets, since a shard can hold more than 2^31 tokens
+    documents = pa.LargeListArray.from_arrays(
+        pa.array(offsets, type=pa.int64()), pa.array(tokens))
+    pq.write_table(pa.table({column: documents}), f"{shard_path}.tmp",
+                   row_group_size=row_group_size)
+    os.replace(f"{shard_path}.tmp", shard_path)
+
+    return shard_path.stat().st_size
+
+def write_shard_index(offsets: np.ndarray, index_path: Path):
+    """ Write the sidecar index of a shard: its document and token counts and
+    a histogram of document lengths, so that DataSet never has to scan the
+    shard for them. Bin i of the histogram holds the documents whose length
+    has bit length i, i.e. lies in [2^(i-1), 2^i), and their total tokens.
+
+    Args:
+        offsets (ndarray): Offsets index of the shard's documents.
+        index_path (Path): Path of the shard's '.index.json' file.
+    """
+    lengths = np.diff(offsets)
+    _, bins = np.frexp(lengths)
+    index = {
+        "documents": len(lengths),
+        "tokens": int(offsets[-1]),
+        "length_histogram": {
+            "counts": np.bincount(bins, minlength=1).tolist(),
+            "tokens": np.bincount(bins, weights=lengths, minlength=1) \
+                .astype(np.int64).tolist()}}
+
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(f"{index_path}.tmp", index_path)
 
-    # Load the dataset from disk into dask
-    dataset = dd.read_parquet(path=dataset_path, 
-                              columns=[config.dataset_feature])
-    
-    tokenizer = PreTrainedTokenizerFast.from_pretrained(config.tokenizer_path)
+def write_document_lengths(offsets: np.ndarray, lengths_path: Path) -> int:
+    """ Write the number of tokens of every document of a "parquet" shard,
+    which DataSet maps with numpy.memmap to count the exact number of batches
+    of every dataloader worker. "memmap" shards get them from their offsets.
 
-    def tokenization_partition(partition):
-        tokenization_dataframe = lambda series: \
-            tokenizer(
-                series,
-                padding=False,
-                truncation=False,
-                return_token_type_ids=False,
-                return_attention_mask=False)["input_ids"]
+    Args:
+        offsets (ndarray): Offsets index of the shard's documents.
+        lengths_path (Path): Path of the shard's '.lengths.npy' file.
 
-        tokenized_data = partition[config.dataset_feature] \
-            .map(tokenization_dataframe, na_action='ignore').to_frame()
+    Returns:
+        The number of bytes written.
+    """
+    lengths = np.diff(offsets)
+    with open(f"{lengths_path}.tmp", "wb") as f:
+        np.save(f, lengths)
+    os.replace(f"{lengths_path}.tmp", lengths_path)
 
-        return tokenized_data
+    return lengths.nbytes
 
-    dataset = dataset.map_partitions(tokenization_partition)
+def shard_files(shard_name: str, dataset_format: str) -> list:
+    """ Names of the files of a tokenized shard, in the order they're written.
+    Args:
+        shard_name (str): Name of the raw file, without its extension.
+        dataset_format (str): Either "parquet" or "memmap".
+    """
+    if dataset_format == "parquet":
+        files = [f"{shard_name}.parquet", f"{shard_name}.lengths.npy"]
+    elif dataset_format == "memmap":
+        files = [f"{shard_name}.tokens.npy", f"{shard_name}.offsets.npy"]
+    return files + [f"{shard_name}.index.json"]
+
+def tokenize_file(raw_path: Path, entry: dict, config, split_dir: Path,
+                  dtype: type, fingerprint: str) -> dict:
+    """ Tokenize one raw parquet file and write it as one shard of the
+    tokenized dataset, unless its manifest entry shows that the shard is
+    already up to date.
+
+    Args:
+        raw_path (Path): Path of the raw parquet file.
+        entry (dict): Manifest entry from the previous run, or None.
+        config (Struct): A Struct object with all configuration fields.
+        split_dir (Path): Folder of the tokenized split.
+        dtype (type): Integer type to store the tokens with.
+        fingerprint (str): Fingerprint of the tokenizer.
+
+    Returns:
+        The manifest entry of the shard, with "skipped" set when it was
+        already up to date.
+    """
+    raw_hash = file_hash(raw_path)
+    shard_name = raw_path.name.removesuffix(".parquet")
+    files = shard_files(shard_name, config.dataset_format)
+    row_group_size = config.tokenized_row_group_size \
+        if config.dataset_format == "parquet" else None
+    # Shards written before a file was added to the format, or with other
+    # row groups, are rewritten
+    if entry is not None and entry["hash"] == raw_hash and \
+            entry["tokenizer"] == fingerprint and entry["files"] == files and \
+            entry.get("row_group_size") == row_group_size and \
+            all((split_dir / name).exists() for name in files):
+        return dict(entry, skipped=True)
+
+    texts = pq.read_table(raw_path, columns=[config.dataset_feature]) \
+        .column(0).drop_null().to_pylist()
+    tokens, offsets = tokenize_partition(
+        texts, config.tokenizer_path, dtype, config.tokenize_batch_size)
+
+    if config.dataset_format == "parquet":
+        num_bytes = write_parquet_shard(
+            tokens, offsets, split_dir / files[0], config.dataset_feature,
+            row_group_size)
+        num_bytes += write_document_lengths(offsets, split_dir / files[1])
+    elif config.dataset_format == "memmap":
+        num_bytes = write_token_shard(tokens, offsets, split_dir / shard_name)
+
+    write_shard_index(offsets, split_dir / files[-1])
+
+    return {
+        "hash": raw_hash,
+        "tokenizer": fingerprint,
+        "files": files,
+        "row_group_size": row_group_size,
+        "documents": len(offsets) - 1,
+        "tokens": len(tokens),
+        "bytes": num_bytes,
+        "skipped": False}
+
+def tokenize_data(config, split):
+
+    if config.dataset_format not in ("parquet", "memmap"):
+        raise ValueError(
+            f"Dataset format '{config.dataset_format}' not supported!")
+
+    # Dataset path
+    raw_paths = sorted((Path(config.raw_dataset_path) / split).glob('*.parquet'))
+
+    tokenizer = load_tokenizer(config.tokenizer_path)
+    dtype = token_dtype(len(tokenizer))
+    fingerprint = tokenizer_fingerprint(tokenizer)
+
+    # Threads used by each process's Rust tokenizer; must be set before the
+    # tokenizer processes start
+    os.environ["RAYON_NUM_THREADS"] = str(config.tokenizer_threads)
 
     # Make sure directory for tokenized dataset exists
-    tokenized_dataset_dir = Path(config.tokenized_dataset_path)
-    tokenized_dataset_dir.mkdir(parents=True, exist_ok=True)
+    split_dir = Path(config.tokenized_dataset_path) / split
+    split_dir.mkdir(parents=True, exist_ok=True)
+
+    # The manifest records, for every raw file, the hash it had and the
+    # tokenizer it was tokenized with, so unchanged files are skipped
+    manifest_path = split_dir / f"manifest.{config.dataset_format}.json"
+    manifest = {}
+    if manifest_path.exists():
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
 
     print(f"Saving tokenized data to {config.tokenized_dataset_path}")
-    
-    dataset.to_parquet(tokenized_dataset_dir / split, 
-                             schema={"text": pa.list_(pa.int64())})
+
+    # Tokenize and write each raw file to its own shard, in parallel
+    # processes; only the manifest entries are sent back
+    start_time = time.time()
+    shard_writes = [
+        dask.delayed(tokenize_file)(
+            raw_path, manifest.get(raw_path.name), config, split_dir, dtype,
+            fingerprint)
+        for raw_path in raw_paths]
+    entries = dask.compute(*shard_writes,
+                           scheduler="processes",
+                           num_workers=config.num_proc)
+    elapsed = time.time() - start_time
+
+    # Remove the shards of raw files that no longer exist
+    for name in manifest.keys() - {raw_path.name for raw_path in raw_paths}:
+        for file_name in manifest[name]["files"]:
+            (split_dir / file_name).unlink(missing_ok=True)
+
+    # Replace the manifest atomically, now that every shard is in place
+    new_manifest = {raw_path.name: {key: value for key, value in entry.items()
+                                    if key != "skipped"}
+                    for raw_path, entry in zip(raw_paths, entries)}
+    with open(f"{manifest_path}.tmp", "w") as f:
+        json.dump(new_manifest, f, indent=4)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+    written = [entry for entry in entries if not entry["skipped"]]
+    num_documents = sum(entry["documents"] for entry in written)
+    num_tokens = sum(entry["tokens"] for entry in written)
+    num_bytes = sum(entry["bytes"] for entry in written)
+    print(f"Skipped {len(entries) - len(written)} up-to-date shards and " + \
+        f"removed {len(manifest.keys() - new_manifest.keys())} stale shards")
+    print(f"Wrote {num_documents} documents ({num_tokens} tokens) to " + \
+        f"{len(written)} {np.dtype(dtype).name} {config.dataset_format} " + \
+        f"shards ({num_bytes:,} bytes)")
+    print(f"Tokenized {num_tokens / elapsed:,.0f} tokens/sec in " + \
+        f"{elapsed:.1f} seconds with {config.num_proc} processes x " + \
+        f"{config.tokenizer_threads} threads")
 
     print('Done!')
 
 
 if __name__ == "__main__":
+    ProgressBar().register()
+
     parser = argparse.ArgumentParser(description='Tokenize data')
     parser.add_argument('config_path', 
                         type=str, 
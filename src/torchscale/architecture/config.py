@@ -291,6 +291,12 @@ class RetNetConfig(PretrainedConfig):
         # Blockwise
         self.chunkwise_recurrent = kwargs.pop("chunkwise_recurrent", False)
         self.recurrent_chunk_size = kwargs.pop("recurrent_chunk_size", 512)
+        # How the state is carried across chunks: "loop" (one chunk at a
+        # time) or "parallel" (closed-form cumulative sum over all chunks)
+        self.recurrent_chunk_scan = kwargs.pop("recurrent_chunk_scan", "loop")
+        # Parallel retention in tiles of this many tokens, in memory linear in
+        # the sequence length; the full mask is built if not set
+        self.parallel_block_size = kwargs.pop("parallel_block_size", None)
         # Text
         self.vocab_size = kwargs.pop("vocab_size", -1)
         # Fairscale
@@ -20,6 +20,14 @@ try:
 except ModuleNotFoundError:
     from torch.nn import LayerNorm
 
+def segment_lengths(segment_ids):
+    """ Lengths of the runs of equal segment ids that the flattened batch of
+    segment ids is cut into; runs never span two samples. """
+    starts = torch.ones_like(segment_ids, dtype=torch.bool)
+    starts[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+    starts = starts.flatten().nonzero().flatten()
+    return torch.diff(starts, append=starts.new_tensor([segment_ids.numel()]))
+
 class DecoderLayer(nn.Module):
     def __init__(
         self,
@@ -141,6 +149,7 @@ class DecoderLayer(nn.Module):
         self_attn_rel_pos=None,
         cross_attn_rel_pos=None,
         is_first_step=False,
+        self_attn_seqlens=None,
     ):
         residual = x
         if self.normalize_before:
@@ -156,6 +165,7 @@ class DecoderLayer(nn.Module):
             rel_pos=self_attn_rel_pos,
             is_first_step=is_first_step,
             is_causal=True,
+            seqlens=self_attn_seqlens,
         )
         x = self.dropout_module(x)
 
@@ -394,6 +404,7 @@ class Decoder(nn.Module):
         features_only=False,
         return_all_hiddens=False,
         token_embeddings=None,
+        segment_ids=None,
         **kwargs
     ):
         # embed tokens and positions
@@ -421,6 +432,18 @@ class Decoder(nn.Module):
             if incremental_state is not None and not is_first_step:
                 cross_attn_rel_pos_bias = cross_attn_rel_pos_bias[-1:, :, :]
 
+        # Documents of packed sequences only attend to themselves: either
+        # through a per-sample block-diagonal mask, or by running flash
+        # attention on every document as a sequence of its own
+        segment_mask = None
+        self_attn_seqlens = None
+        if segment_ids is not None and (incremental_state is None or is_first_step):
+            if not self.args.flash_attention:
+                segment_mask = (segment_ids[:, :, None] != segment_ids[:, None, :]) \
+                    .repeat_interleave(self.args.decoder_attention_heads, dim=0)
+            else:
+                self_attn_seqlens = segment_lengths(segment_ids)
+
         # decoder layers
         inner_states = [x]
 
@@ -439,6 +462,9 @@ class Decoder(nn.Module):
                         .type_as(x),
                         1,
                     )
+                    if segment_mask is not None:
+                        self_attn_mask = self_attn_mask.masked_fill(
+                            segment_mask, float("-inf"))
                 else:
                     self_attn_mask = None
                 if is_first_step and incremental_state is not None:
@@ -461,6 +487,7 @@ class Decoder(nn.Module):
                 self_attn_rel_pos=self_attn_rel_pos_bias,
                 cross_attn_rel_pos=cross_attn_rel_pos_bias,
                 is_first_step=is_first_step,
+                self_attn_seqlens=self_attn_seqlens,
             )
             l_aux.append(l_aux_i)
             inner_states.append(x)
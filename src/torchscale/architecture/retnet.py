@@ -28,19 +28,57 @@ class RetNetRelPos(nn.Module):
         self.register_buffer("angle", angle)
         self.register_buffer("decay", decay)
         self.recurrent_chunk_size = args.recurrent_chunk_size
-        
-    def forward(self, slen, activate_recurrent=False, chunkwise_recurrent=False):
-        if activate_recurrent:
-            sin = torch.sin(self.angle * (slen - 1))
-            cos = torch.cos(self.angle * (slen - 1))
-            retention_rel_pos = ((sin, cos), self.decay.exp())
-        elif chunkwise_recurrent:
-            index = torch.arange(slen).to(self.decay)
-            sin = torch.sin(index[:, None] * self.angle[None, :])
-            cos = torch.cos(index[:, None] * self.angle[None, :])
-
-            block_index = torch.arange(self.recurrent_chunk_size).to(self.decay)
-            mask = torch.tril(torch.ones(self.recurrent_chunk_size, self.recurrent_chunk_size).to(self.decay))
+        self.parallel_block_size = args.parallel_block_size
+        # Rotary tables and decay masks, keyed by mode, dtype and device; they
+        # only depend on the buffers, so they are built once instead of on
+        # every forward
+        self.cache = {}
+
+    def cached(self, key, build, length=None):
+        # Entries with a length hold the tables of the longest sequence seen
+        # so far; shorter sequences use their leading rows
+        key = (key, self.decay.dtype, self.decay.device)
+        entry = self.cache.get(key)
+        if entry is None or (length is not None and entry[0] < length):
+            # Built outside of inference mode, so that tables first built
+            # during validation or generation can still be used in training
+            with torch.inference_mode(False), torch.no_grad():
+                entry = (length, build(length) if length is not None else build())
+            self.cache[key] = entry
+        return entry[1]
+
+    def rotation(self, slen):
+        # Rotation of every (even, odd) pair of query/key features at every
+        # position, as unit complex numbers
+        def build(length):
+            # In the buffers' dtype, but at least float32 as complex numbers
+            # need
+            dtype = torch.promote_types(self.angle.dtype, torch.float32)
+            index = torch.arange(length, device=self.angle.device, dtype=dtype)
+            angle = index[:, None] * self.angle[None, ::2].to(dtype)
+            return torch.polar(torch.ones_like(angle), angle)
+        # Grown in powers of two, so generation rarely rebuilds the table
+        length = 1 << max(slen - 1, 0).bit_length()
+        return self.cached("rotation", build, length=length)[:slen]
+
+    def parallel_mask(self, slen):
+        def build(length):
+            index = torch.arange(length).to(self.decay)
+            mask = torch.tril(torch.ones(length, length).to(self.decay))
+            mask = torch.masked_fill(index[:, None] - index[None, :], ~mask.bool(), float("inf"))
+            mask = torch.exp(mask * self.decay[:, None, None])
+            mask = torch.nan_to_num(mask)
+            # Row sums only cover earlier positions, so the normalized mask
+            # of a shorter sequence is the leading block of this one
+            scale = mask.sum(dim=-1, keepdim=True).sqrt()
+            return mask / scale, scale
+        mask, scale = self.cached("parallel", build, length=slen)
+        return mask[:, :slen, :slen], scale[:, :slen]
+
+    def chunk_masks(self, chunk_size):
+        def build():
+            block_index = torch.arange(chunk_size).to(self.decay)
+            mask = torch.tril(torch.ones(chunk_size, chunk_size).to(self.decay))
             mask = torch.masked_fill(block_index[:, None] - block_index[None, :], ~mask.bool(), float("inf"))
             mask = torch.exp(mask * self.decay[:, None, None])
             mask = torch.nan_to_num(mask)
@@ -50,24 +88,51 @@ class RetNetRelPos(nn.Module):
             scale = mask.sum(dim=-1, keepdim=True).sqrt()
             inner_mask = mask / scale
 
-            cross_decay = torch.exp(self.decay * self.recurrent_chunk_size)
+            cross_decay = torch.exp(self.decay * chunk_size)
             query_inner_decay = torch.exp(self.decay[:, None] * (block_index + 1))
             query_inner_decay = query_inner_decay[:, :, None] / (scale / mask[:, -1].sum(dim=-1)[:, None, None])
             cross_decay = cross_decay[:, None, None]
-            retention_rel_pos = ((sin, cos), (inner_mask, cross_decay, query_inner_decay, value_inner_decay))
+            return inner_mask, cross_decay, query_inner_decay, value_inner_decay
+        # Only the configured chunk size is cached: prefill reads prompts
+        # shorter than a chunk as one chunk of their own length, and caching
+        # every such length would keep adding masks on the device
+        if chunk_size != self.recurrent_chunk_size:
+            return build()
+        return self.cached("chunk", build)
+        
+    def forward(self, slen, activate_recurrent=False, chunkwise_recurrent=False, segment_ids=None, chunk_size=None):
+        if activate_recurrent:
+            rotation = self.rotation(slen)[slen - 1]
+            retention_rel_pos = (rotation, self.cached("recurrent", self.decay.exp))
+        elif chunkwise_recurrent:
+            rotation = self.rotation(slen)
+            chunk_size = chunk_size or self.recurrent_chunk_size
+            retention_rel_pos = (rotation, self.chunk_masks(chunk_size))
+        elif self.parallel_block_size:
+            # Tiled retention builds the mask of every tile itself
+            rotation = self.rotation(slen)
+            retention_rel_pos = (rotation, (self.decay, segment_ids))
         else:
-            index = torch.arange(slen).to(self.decay)
-            sin = torch.sin(index[:, None] * self.angle[None, :])
-            cos = torch.cos(index[:, None] * self.angle[None, :])
-            mask = torch.tril(torch.ones(slen, slen).to(self.decay))
-            mask = torch.masked_fill(index[:, None] - index[None, :], ~mask.bool(), float("inf"))
-            mask = torch.exp(mask * self.decay[:, None, None])
-            mask = torch.nan_to_num(mask)
-            mask = mask / mask.sum(dim=-1, keepdim=True).sqrt()
-            retention_rel_pos = ((sin, cos), mask)
+            rotation = self.rotation(slen)
+            mask, scale = self.parallel_mask(slen)
+            if segment_ids is not None:
+                # Block-diagonal decay per sample: tokens only retain tokens of
+                # their own document, normalized as if the document started
+                # the sequence
+                same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]
+                mask = mask * scale * same_segment[:, None].to(mask)
+                mask = mask / mask.sum(dim=-1, keepdim=True).sqrt()
+            retention_rel_pos = (rotation, mask)
 
         return retention_rel_pos
 
+    def state_decay(self, length, slen):
+        # Weight of every token in the recurrent state after the first length
+        # tokens; padding up to slen has none
+        index = torch.arange(slen).to(self.decay)
+        decay = torch.exp((length - 1 - index) * self.decay[:, None])
+        return decay.masked_fill(index >= length, 0)
+
 class DecoderLayer(nn.Module):
     def __init__(
         self,
@@ -157,6 +222,8 @@ class DecoderLayer(nn.Module):
         incremental_state=None,
         chunkwise_recurrent=False,
         retention_rel_pos=None,
+        segment_ids=None,
+        state_decay=None,
     ):
         residual = x
         if self.normalize_before:
@@ -167,6 +234,8 @@ class DecoderLayer(nn.Module):
             incremental_state=incremental_state,
             rel_pos=retention_rel_pos,
             chunkwise_recurrent=chunkwise_recurrent,
+            segment_ids=segment_ids,
+            state_decay=state_decay,
         )
         x = self.dropout_module(x)
 
@@ -332,6 +401,7 @@ class RetNetDecoder(nn.Module):
         features_only=False,
         return_all_hiddens=False,
         token_embeddings=None,
+        segment_ids=None,
         **kwargs
     ):
         # embed tokens
@@ -339,16 +409,41 @@ class RetNetDecoder(nn.Module):
             prev_output_tokens, token_embeddings, incremental_state
         )
         is_first_step = self.is_first_step(incremental_state)
-
+        recurrent = incremental_state is not None and not is_first_step
+        # The first step reads the whole prompt in the chunkwise form and
+        # leaves the state ready for recurrent steps
+        prefill = incremental_state is not None and is_first_step
+        chunkwise_recurrent = (self.chunkwise_recurrent and not recurrent) or prefill
+        chunk_size = self.recurrent_chunk_size
+        if prefill:
+            # Prompts shorter than a chunk aren't padded
+            chunk_size = min(chunk_size, prev_output_tokens.size(1))
+
+        # Document segments of packed sequences only apply to training
+        if incremental_state is not None:
+            segment_ids = None
         
-        if self.chunkwise_recurrent and prev_output_tokens.size(1) % self.recurrent_chunk_size != 0:
-            padding_len = self.recurrent_chunk_size - prev_output_tokens.size(1) % self.recurrent_chunk_size
+        # Recurrent steps take a single token, so they are never padded
+        chunk_padded = chunkwise_recurrent and \
+            prev_output_tokens.size(1) % chunk_size != 0
+        if chunk_padded:
+            padding_len = chunk_size - prev_output_tokens.size(1) % chunk_size
             slen = prev_output_tokens.size(1) + padding_len
             x = F.pad(x, (0, 0, 0, padding_len))
+            if segment_ids is not None:
+                # Padding forms a segment of its own
+                segment_ids = F.pad(segment_ids, (0, padding_len), value=-1)
         else:
             slen = prev_output_tokens.size(1)
         # relative position
-        retention_rel_pos = self.retnet_rel_pos(slen, incremental_state is not None and not is_first_step, chunkwise_recurrent=self.chunkwise_recurrent)
+        retention_rel_pos = self.retnet_rel_pos(
+            slen, recurrent,
+            chunkwise_recurrent=chunkwise_recurrent,
+            segment_ids=None if chunkwise_recurrent else segment_ids,
+            chunk_size=chunk_size)
+        state_decay = None
+        if prefill:
+            state_decay = self.retnet_rel_pos.state_decay(prev_output_tokens.size(1), slen)
         # decoder layers
         inner_states = [x]
 
@@ -367,12 +462,17 @@ class RetNetDecoder(nn.Module):
                 x,
                 incremental_state[idx] if incremental_state is not None else None,
                 retention_rel_pos=retention_rel_pos,
-                chunkwise_recurrent=self.chunkwise_recurrent,
+                chunkwise_recurrent=chunkwise_recurrent,
+                segment_ids=segment_ids,
+                state_decay=state_decay,
             )
             l_aux.append(l_aux_i)
             inner_states.append(x)
+
+        if prefill:
+            incremental_state["is_first_step"] = False
             
-        if self.chunkwise_recurrent and prev_output_tokens.size(1) % self.recurrent_chunk_size != 0:
+        if chunk_padded:
             x = x[:, :prev_output_tokens.size(1), :]
 
         if self.layer_norm is not None:
@@ -387,5 +487,15 @@ class RetNetDecoder(nn.Module):
             "attn": None,
         }
 
+    def init_incremental_state(self, bsz, device=None, dtype=None):
+        # Preallocated recurrent state of every layer, updated in place by
+        # recurrent steps
+        decay = self.retnet_rel_pos.decay
+        return {
+            idx: layer.retention.init_incremental_state(
+                bsz, device=device, dtype=dtype, scale_dtype=decay.dtype)
+            for idx, layer in enumerate(self.layers)
+        }
+
     def output_layer(self, features):
         return self.output_projection(features)
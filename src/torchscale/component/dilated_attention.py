@@ -141,9 +141,11 @@ class DilatedAttention(MultiheadAttention):
         rel_pos=None,
         is_first_step=False,
         is_causal=False,
+        seqlens=None,
     ):
         assert self.args.flash_attention
         assert rel_pos is None
+        assert seqlens is None, "Document segments are not supported by dilated attention."
         bsz, tgt_len, embed_dim = query.size()
         src_len = tgt_len
         assert embed_dim == self.embed_dim, f"query dim {embed_dim} != {self.embed_dim}"
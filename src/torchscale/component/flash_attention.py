@@ -4,17 +4,32 @@
 
 from typing import Any, Optional
 import torch
+import torch.nn.functional as F
 
 if torch.cuda.is_available():
     try:
         if torch.cuda.get_device_capability()[0] > 7:
             from flash_attn.flash_attn_interface import flash_attn_func as _flash_attn_func
 
+            from flash_attn.flash_attn_interface import flash_attn_varlen_func as _flash_attn_varlen_func
+
             def flash_attn_func(q, k, v, dropout=0.0, bias=None, softmax_scale=None, is_causal=False):
                 assert bias is None
                 attn, lse, _ = _flash_attn_func(q, k, v, dropout_p=dropout, softmax_scale=softmax_scale, causal=is_causal, return_attn_probs=True)
                 return attn, lse
 
+            def segment_flash_attn_func(q, k, v, seqlens, dropout=0.0, softmax_scale=None):
+                # Causal attention within each of the sequences of the given
+                # lengths that the flattened batch is cut into
+                bsz, seq_len = q.shape[:2]
+                cu_seqlens = F.pad(seqlens.cumsum(0, dtype=torch.int32), (1, 0))
+                max_seqlen = int(seqlens.max())
+                attn = _flash_attn_varlen_func(
+                    q.flatten(0, 1), k.flatten(0, 1), v.flatten(0, 1),
+                    cu_seqlens, cu_seqlens, max_seqlen, max_seqlen,
+                    dropout_p=dropout, softmax_scale=softmax_scale, causal=True)
+                return attn.view(bsz, seq_len, *attn.shape[1:])
+
         else:
             from xformers.ops.fmha import (
                 cutlass,
@@ -24,6 +39,7 @@ if torch.cuda.is_available():
                 _memory_efficient_attention_backward,
                 LowerTriangularMask,
             )
+            from xformers.ops.fmha.attn_bias import BlockDiagonalCausalMask
 
             class FlashAttnFunc(torch.autograd.Function):
                 @staticmethod
@@ -117,7 +133,19 @@ if torch.cuda.is_available():
                     return grads.dq, grads.dk, grads.dv, None, grads.db, None, None
             
             flash_attn_func = FlashAttnFunc.apply
+
+            def segment_flash_attn_func(q, k, v, seqlens, dropout=0.0, softmax_scale=None):
+                # Causal attention within each of the sequences of the given
+                # lengths that the flattened batch is cut into
+                bsz, seq_len = q.shape[:2]
+                bias = BlockDiagonalCausalMask.from_seqlens(seqlens.tolist())
+                attn, _ = flash_attn_func(
+                    q.flatten(0, 1)[None], k.flatten(0, 1)[None], v.flatten(0, 1)[None],
+                    dropout, bias, softmax_scale, False)
+                return attn.view(bsz, seq_len, *attn.shape[2:])
     except ModuleNotFoundError:
         flash_attn_func = None
+        segment_flash_attn_func = None
 else:
     flash_attn_func = None
+    segment_flash_attn_func = None
@@ -14,7 +14,7 @@ except ModuleNotFoundError:
 
 from .multiway_network import MultiwayWrapper
 from .xpos_relative_position import XPOS
-from .flash_attention import flash_attn_func
+from .flash_attention import flash_attn_func, segment_flash_attn_func
 
 
 class MultiheadAttention(nn.Module):
@@ -65,14 +65,16 @@ class MultiheadAttention(nn.Module):
         nn.init.xavier_uniform_(self.out_proj.weight)
         nn.init.constant_(self.out_proj.bias, 0.0)
 
-    def attention_ops(self, q, k, v, key_padding_mask=None, attn_mask=None, rel_pos=None, is_causal=False):
+    def attention_ops(self, q, k, v, key_padding_mask=None, attn_mask=None, rel_pos=None, is_causal=False, seqlens=None):
         if not self.args.flash_attention:
             q *= self.scaling
             attn_weights = torch.bmm(q, k.transpose(1, 2))
 
             if attn_mask is not None:
                 attn_weights = torch.nan_to_num(attn_weights)
-                attn_mask = attn_mask.unsqueeze(0)
+                # Masks are either shared by the batch or given per sample
+                if attn_mask.dim() == 2:
+                    attn_mask = attn_mask.unsqueeze(0)
                 attn_weights += attn_mask
 
             if key_padding_mask is not None:
@@ -101,9 +103,17 @@ class MultiheadAttention(nn.Module):
             k = rearrange(k, '(b h) l d -> b l h d', h=self.num_heads).half()
             v = rearrange(v, '(b h) l d -> b l h d', h=self.num_heads).half()
 
-            attn, lse = flash_attn_func(q, k, v, self.dropout, attn_mask, None, is_causal)
-            attn = rearrange(attn, 'b l h d -> b l (h d)')
-            attn_weights = lse[:, :, :attn.size(1)]
+            if seqlens is not None:
+                # Block-diagonal causal attention over the documents of
+                # packed sequences
+                assert segment_flash_attn_func is not None
+                attn = segment_flash_attn_func(q, k, v, seqlens, self.dropout)
+                attn = rearrange(attn, 'b l h d -> b l (h d)')
+                attn_weights = None
+            else:
+                attn, lse = flash_attn_func(q, k, v, self.dropout, attn_mask, None, is_causal)
+                attn = rearrange(attn, 'b l h d -> b l (h d)')
+                attn_weights = lse[:, :, :attn.size(1)]
 
         return attn, attn_weights
 
@@ -118,6 +128,7 @@ class MultiheadAttention(nn.Module):
         rel_pos=None,
         is_first_step=False,
         is_causal=False,
+        seqlens=None,
     ):
         bsz, tgt_len, embed_dim = query.size()
         src_len = tgt_len
@@ -162,7 +173,7 @@ class MultiheadAttention(nn.Module):
             k = self.xpos(k, offset=0, downscale=True)
             q = self.xpos(q, offset=offset, downscale=False)
 
-        attn, attn_weights = self.attention_ops(q, k, v, key_padding_mask=key_padding_mask, attn_mask=attn_mask, rel_pos=rel_pos, is_causal=is_causal)
+        attn, attn_weights = self.attention_ops(q, k, v, key_padding_mask=key_padding_mask, attn_mask=attn_mask, rel_pos=rel_pos, is_causal=is_causal, seqlens=seqlens)
 
         if self.inner_attn_ln is not None:
             # Convert data back to float32, since inner_attn_ln only works with float32
@@ -1,6 +1,7 @@
 # Copyright (c) 2022 Microsoft
 # Licensed under The MIT License [see LICENSE for details]
 
+import math
 
 import torch
 import torch.nn.functional as F
@@ -9,24 +10,87 @@ from .rms_norm import RMSNorm
 
 from .multiway_network import MultiwayWrapper
 
-def rotate_every_two(x):
-    x1 = x[:, :, :, ::2]
-    x2 = x[:, :, :, 1::2]
-    x = torch.stack((-x2, x1), dim=-1)
-    return x.flatten(-2)  # in einsum notation: rearrange(x, '... d j -> ... (d j)')\
-
-def duplicate_interleave(m):
+def theta_shift(x, rotation):
+    # Rotating every (even, odd) feature pair is a complex multiplication, so
+    # no rotated copy of x is built. Half precision inputs are rotated in
+    # float32, which complex multiplication needs at least
+    x_complex = torch.view_as_complex(
+        x.to(torch.promote_types(x.dtype, torch.float32)).unflatten(-1, (-1, 2)))
+    return torch.view_as_real(x_complex * rotation).flatten(-2).type_as(x)
+
+def tile_decay(decay, query_index, key_index, segment_ids=None):
+    # Unnormalized decay mask of one (query block, key block) tile
+    distance = (query_index[:, None] - key_index[None, :]).to(decay)
+    exponent = (decay[:, None, None] * distance).masked_fill(distance < 0, float("-inf"))
+    mask = exponent.exp()
+    if segment_ids is not None:
+        same_segment = segment_ids[:, query_index, None] == segment_ids[:, None, key_index]
+        mask = mask * same_segment[:, None].to(mask)
+    return mask
+
+class TiledRetention(torch.autograd.Function):
     """
-    A simple version of `torch.repeat_interleave` for duplicating a matrix while interleaving the copy.
+    Parallel retention computed one (query block, key block) tile at a time,
+    skipping the tiles above the diagonal. Each row's decay normalization and
+    the normalization by its absolute retention score sum are accumulated
+    over the tiles, so the full mask and score matrix are never built. The
+    backward pass recomputes the tiles, so memory grows linearly with the
+    sequence length.
     """
-    dim0 = m.shape[0]
-    m = m.view(-1, 1)  # flatten the matrix
-    m = m.repeat(1, 2)  # repeat all elements into the 2nd dimension
-    m = m.view(dim0, -1)  # reshape into a matrix, interleaving the copy
-    return m
+    @staticmethod
+    def forward(ctx, qr, kr, v, decay, segment_ids, block_size):
+        bsz, num_heads, tgt_len, head_dim = v.size()
+        output = torch.empty_like(v)
+        # Sums are accumulated in at least float32
+        acc_dtype = torch.promote_types(v.dtype, torch.float32)
+        # Weight of every row: the decay normalization over the clamped
+        # absolute score sum, which gets no gradient as in parallel_forward
+        row_weight = torch.empty(bsz, num_heads, tgt_len, 1, device=v.device, dtype=acc_dtype)
+        for start in range(0, tgt_len, block_size):
+            end = min(start + block_size, tgt_len)
+            query_index = torch.arange(start, end, device=v.device)
+            output_sum = torch.zeros(bsz, num_heads, end - start, head_dim, device=v.device, dtype=acc_dtype)
+            abs_sum = torch.zeros(bsz, num_heads, end - start, 1, device=v.device, dtype=acc_dtype)
+            decay_sum = torch.zeros(1, num_heads, end - start, 1, device=v.device, dtype=acc_dtype)
+            for key_start in range(0, end, block_size):
+                key_end = min(key_start + block_size, tgt_len)
+                key_index = torch.arange(key_start, key_end, device=v.device)
+                mask = tile_decay(decay, query_index, key_index, segment_ids)
+                qk_mat = (qr[:, :, start:end] @ kr[:, :, key_start:key_end].transpose(-1, -2)) * mask.to(qr)
+                output_sum += (qk_mat @ v[:, :, key_start:key_end]).to(acc_dtype)
+                abs_sum += qk_mat.abs().sum(dim=-1, keepdim=True).to(acc_dtype)
+                decay_sum = decay_sum + mask.sum(dim=-1, keepdim=True).to(acc_dtype)
+            scale = decay_sum.rsqrt()
+            weight = scale / (scale * abs_sum).clamp(min=1, max=5e4)
+            output[:, :, start:end] = output_sum * weight
+            row_weight[:, :, start:end] = weight
+        ctx.save_for_backward(qr, kr, v, decay, segment_ids, row_weight)
+        ctx.block_size = block_size
+        return output
 
-def theta_shift(x, sin, cos):
-    return (x * cos) + (rotate_every_two(x) * sin)
+    @staticmethod
+    def backward(ctx, grad_output):
+        qr, kr, v, decay, segment_ids, row_weight = ctx.saved_tensors
+        block_size = ctx.block_size
+        tgt_len = v.size(2)
+        acc_dtype = torch.promote_types(v.dtype, torch.float32)
+        grad_q = torch.zeros_like(qr, dtype=acc_dtype)
+        grad_k = torch.zeros_like(kr, dtype=acc_dtype)
+        grad_v = torch.zeros_like(v, dtype=acc_dtype)
+        weighted_grad = (grad_output * row_weight).to(v)
+        for start in range(0, tgt_len, block_size):
+            end = min(start + block_size, tgt_len)
+            query_index = torch.arange(start, end, device=v.device)
+            for key_start in range(0, end, block_size):
+                key_end = min(key_start + block_size, tgt_len)
+                key_index = torch.arange(key_start, key_end, device=v.device)
+                mask = tile_decay(decay, query_index, key_index, segment_ids).to(qr)
+                qk_mat = (qr[:, :, start:end] @ kr[:, :, key_start:key_end].transpose(-1, -2)) * mask
+                grad_v[:, :, key_start:key_end] += qk_mat.transpose(-1, -2) @ weighted_grad[:, :, start:end]
+                grad_qk = (weighted_grad[:, :, start:end] @ v[:, :, key_start:key_end].transpose(-1, -2)) * mask
+                grad_q[:, :, start:end] += grad_qk @ kr[:, :, key_start:key_end]
+                grad_k[:, :, key_start:key_end] += grad_qk.transpose(-1, -2) @ qr[:, :, start:end]
+        return grad_q.to(qr), grad_k.to(kr), grad_v.to(v), None, None, None
 
 def get_activation_fn(activation):
     if activation == "swish":
@@ -86,6 +150,16 @@ class MultiScaleRetention(nn.Module):
         output = output.transpose(1, 2)
         return output
 
+    def tiled_parallel_forward(self, qr, kr, v, inner_mask):
+        decay, segment_ids = inner_mask
+        bsz, tgt_len, embed_dim = v.size()
+
+        vr = v.view(bsz, tgt_len, self.num_heads, self.head_dim).transpose(1, 2)
+
+        output = TiledRetention.apply(qr, kr, vr, decay, segment_ids, self.args.parallel_block_size)
+        output = output.transpose(1, 2)
+        return output
+
     def recurrent_forward(
         self,
         qr, kr, v,
@@ -97,24 +171,135 @@ class MultiScaleRetention(nn.Module):
         v = v.view(bsz, self.num_heads, self.head_dim, 1)
         kv = kr * v
         if "prev_key_value" in incremental_state:
+            # The state is updated in place, so preallocated buffers are reused
+            # for every token
             prev_kv = incremental_state["prev_key_value"]
-            prev_scale = incremental_state["scale"]
-            scale = prev_scale * decay + 1
-            kv = prev_kv * (prev_scale.sqrt() * decay / scale.sqrt()).view(self.num_heads, 1, 1) + kv / scale.sqrt().view(self.num_heads, 1, 1)
+            scale = incremental_state["scale"]
+            prev_scale_sqrt = scale.sqrt()
+            scale.mul_(decay).add_(1)
+            scale_sqrt = scale.sqrt().view(self.num_heads, 1, 1)
+            prev_kv.mul_(prev_scale_sqrt.view(self.num_heads, 1, 1) * decay.view(self.num_heads, 1, 1) / scale_sqrt)
+            kv = prev_kv.add_(kv / scale_sqrt)
             # kv = prev_kv * decay.view(self.num_heads, 1, 1) + kv
         else:
             scale = torch.ones_like(decay)
+            incremental_state["prev_key_value"] = kv
+            incremental_state["scale"] = scale
 
-        incremental_state["prev_key_value"] = kv
-        incremental_state["scale"] = scale
-
-        output = torch.sum(qr * kv, dim=3)
+        output = torch.matmul(kv, qr.transpose(-1, -2)).squeeze(-1)
         return output
+
+    def prefill_state(self, kr, v, state_decay, incremental_state):
+        # Recurrent state after the prompt, normalized like recurrent_forward
+        # leaves it
+        bsz, tgt_len, _ = v.size()
+        vr = v.view(bsz, tgt_len, self.num_heads, self.head_dim).transpose(1, 2)
+        kv = (vr * state_decay[:, :, None].to(v)).transpose(-1, -2) @ kr
+        scale = state_decay.sum(dim=-1)
+        kv = kv / scale.sqrt().view(self.num_heads, 1, 1).to(v)
+        if "prev_key_value" in incremental_state:
+            incremental_state["prev_key_value"].copy_(kv)
+            incremental_state["scale"].copy_(scale)
+        else:
+            incremental_state["prev_key_value"] = kv
+            incremental_state["scale"] = scale
+
+    def init_incremental_state(self, bsz, device=None, dtype=None, scale_dtype=None):
+        # Zero state: the first token then gets scale 1, as without a state
+        return {
+            "prev_key_value": torch.zeros(bsz, self.num_heads, self.head_dim, self.key_dim, device=device, dtype=dtype),
+            "scale": torch.zeros(self.num_heads, device=device, dtype=scale_dtype),
+        }
     
+    def loop_chunk_states(self, kv, cross_decay, carry=None):
+        bsz, num_chunks = kv.shape[:2]
+        kv_recurrent = []
+        cross_scale = []
+        kv_state = torch.zeros(bsz, self.num_heads, self.key_dim, self.head_dim).to(kv)
+        kv_scale = torch.ones(bsz, self.num_heads, 1, 1).to(kv)
+        
+        # accumulate kv by loop
+        for i in range(num_chunks):
+            kv_recurrent.append(kv_state / kv_scale)
+            cross_scale.append(kv_scale)
+            if carry is not None:
+                kv_state = kv_state * carry[:, i]
+            kv_state = kv_state * cross_decay + kv[:, i]
+            kv_scale = kv_state.detach().abs().sum(dim=-2, keepdim=True).max(dim=-1, keepdim=True).values.clamp(min=1)
+            
+        kv_recurrent = torch.stack(kv_recurrent, dim=1)
+        cross_scale = torch.stack(cross_scale, dim=1)
+        return kv_recurrent, cross_scale
+
+    def scan_chunk_states(self, kv, cross_decay, carry=None):
+        # Same states as loop_chunk_states, as a closed-form decay-weighted
+        # cumulative sum over the chunks: chunk i holds cross_decay ** (i - j)
+        # of chunk j, unless a document starts in between. The sum is taken
+        # in blocks of about sqrt(num_chunks) chunks with batched matmuls,
+        # within every block and then across the block ends, so a constant
+        # number of kernels runs instead of a loop over the chunks. All
+        # weights are at most 1 and the states are unnormalized as in the
+        # loop, so the range of the values is the same. It moves more memory
+        # than the loop, so it pays off where the loop is bound by kernel
+        # launches: long sequences of many chunks on GPUs
+        bsz, num_chunks = kv.shape[:2]
+        block = math.ceil(math.sqrt(num_chunks))
+        num_blocks = math.ceil(num_chunks / block)
+        padding = num_blocks * block - num_chunks
+        dtype = torch.promote_types(kv.dtype, cross_decay.dtype)
+        log_decay = cross_decay.view(self.num_heads).log().to(dtype)
+
+        # Number of documents started up to every chunk; weights are kept
+        # only between chunks of the same document
+        if carry is None:
+            resets = torch.zeros(bsz, num_chunks, device=kv.device)
+        else:
+            resets = torch.cumsum(1 - carry.view(bsz, num_chunks), dim=1)
+        resets = F.pad(resets, (0, padding), value=-1).view(bsz, num_blocks, 1, block)
+
+        def weights(distance, same_document):
+            # decay ** distance for earlier chunks of the same document, per head
+            distance = distance.to(dtype)
+            exponent = log_decay.view(-1, *[1] * distance.dim()) * distance
+            exponent = exponent.masked_fill(distance < 0, float("-inf"))
+            return exponent.exp() * same_document
+
+        # Within every block
+        index = torch.arange(block, device=kv.device)
+        inner_weights = weights(
+            index[:, None] - index[None, :],
+            resets[..., :, None] == resets[..., None, :])
+        kv = kv.to(dtype)
+        if padding:
+            kv = F.pad(kv, (0, 0, 0, 0, 0, 0, 0, padding))
+        kv = kv.view(bsz, num_blocks, block, self.num_heads, self.key_dim, self.head_dim)
+        states = torch.einsum("bnhij,bnjhkd->bnihkd", inner_weights, kv)
+
+        # Across the block ends
+        block_index = torch.arange(num_blocks, device=kv.device)
+        block_resets = resets[:, :, 0, -1]
+        block_weights = weights(
+            block * (block_index[:, None] - block_index[None, :]),
+            block_resets[:, None, :, None] == block_resets[:, None, None, :])
+        block_states = torch.einsum("bhij,bjhkd->bihkd", block_weights, states[:, :, -1])
+
+        # Every chunk adds the state at the end of the previous block
+        prev_states = F.pad(block_states[:, :-1], (0, 0, 0, 0, 0, 0, 1, 0))
+        prev_resets = F.pad(block_resets[:, :-1], (1, 0), value=0)
+        carry_weights = weights(index + 1, resets == prev_resets[:, :, None, None])
+        states = states + carry_weights.transpose(2, 3)[..., None, None] * prev_states[:, :, None]
+        states = states.reshape(bsz, num_blocks * block, self.num_heads, self.key_dim, self.head_dim)[:, :num_chunks]
+
+        # Every chunk reads the state left by the chunks before it
+        kv_state = F.pad(states[:, :-1], (0, 0, 0, 0, 0, 0, 1, 0))
+        kv_scale = kv_state.detach().abs().sum(dim=-2, keepdim=True).max(dim=-1, keepdim=True).values.clamp(min=1)
+        return kv_state / kv_scale, kv_scale
+
     def chunk_recurrent_forward(
         self,
         qr, kr, v,
-        inner_mask
+        inner_mask,
+        segment_ids=None
     ):
         mask, cross_decay, query_inner_decay, value_inner_decay = inner_mask
         bsz, tgt_len, embed_dim = v.size()
@@ -129,6 +314,19 @@ class MultiScaleRetention(nn.Module):
 
         kr_t = kr.transpose(-1, -2)
 
+        if segment_ids is not None:
+            # Segment ids of every chunk, and of the token before every chunk
+            segments = segment_ids.view(bsz, num_chunks, chunk_len)
+            prev_segments = F.pad(segment_ids, (1, 0), value=-1)[:, :-1:chunk_len]
+            # Tokens only retain tokens of their own document within a chunk
+            mask = mask * (segments[:, :, None, :, None] == segments[:, :, None, None, :]).to(v)
+            # Only the last document of a chunk is carried over to the next one
+            value_inner_decay = value_inner_decay * (segments == segments[:, :, -1:])[:, :, None, :, None].to(v)
+            # The state is reset after a chunk that starts a new document
+            carry = (segments[:, :, -1] == prev_segments).to(v)[:, :, None, None, None]
+            # Only tokens of the document the state belongs to read it
+            query_continues = (segments == prev_segments[:, :, None])[:, :, None, :, None].to(v)
+
         qk_mat = qr @ kr_t # bsz * num_heads * chunk_len * chunk_len
         qk_mat = qk_mat * mask
         inner_scale = qk_mat.detach().abs().sum(dim=-1, keepdim=True).clamp(min=1)
@@ -138,26 +336,22 @@ class MultiScaleRetention(nn.Module):
         # reduce kv in one chunk
         kv = kr_t @ (v * value_inner_decay)
 
-        kv_recurrent = []
-        cross_scale = []
-        kv_state = torch.zeros(bsz, self.num_heads, self.key_dim, self.head_dim).to(v)
-        kv_scale = torch.ones(bsz, self.num_heads, 1, 1).to(v)
-        
-        # accumulate kv by loop
-        for i in range(num_chunks):
-            kv_recurrent.append(kv_state / kv_scale)
-            cross_scale.append(kv_scale)
-            kv_state = kv_state * cross_decay + kv[:, i]
-            kv_scale = kv_state.detach().abs().sum(dim=-2, keepdim=True).max(dim=-1, keepdim=True).values.clamp(min=1)
-            
-        kv_recurrent = torch.stack(kv_recurrent, dim=1)
-        cross_scale = torch.stack(cross_scale, dim=1)
+        if segment_ids is None:
+            carry = None
+        if self.args.recurrent_chunk_scan == "parallel":
+            kv_recurrent, cross_scale = self.scan_chunk_states(kv, cross_decay, carry)
+        elif self.args.recurrent_chunk_scan == "loop":
+            kv_recurrent, cross_scale = self.loop_chunk_states(kv, cross_decay, carry)
+        else:
+            raise ValueError(f"Chunk scan '{self.args.recurrent_chunk_scan}' not supported!")
         
         all_scale = torch.maximum(inner_scale, cross_scale)
         align_inner_scale = all_scale / inner_scale
         align_cross_scale = all_scale / cross_scale
 
         cross_output = (qr * query_inner_decay) @ kv_recurrent
+        if segment_ids is not None:
+            cross_output = cross_output * query_continues
         output = inner_output / align_inner_scale + cross_output / align_cross_scale
         # output = inner_output / cross_scale + cross_output / inner_scale
 
@@ -169,10 +363,12 @@ class MultiScaleRetention(nn.Module):
         x,
         rel_pos,
         chunkwise_recurrent=False,
-        incremental_state=None
+        incremental_state=None,
+        segment_ids=None,
+        state_decay=None
     ):
         bsz, tgt_len, _ = x.size()
-        (sin, cos), inner_mask = rel_pos
+        rotation, inner_mask = rel_pos
 
         q = self.q_proj(x)
         k = self.k_proj(x)
@@ -183,13 +379,18 @@ class MultiScaleRetention(nn.Module):
         q = q.view(bsz, tgt_len, self.num_heads, self.key_dim).transpose(1, 2)
         k = k.view(bsz, tgt_len, self.num_heads, self.key_dim).transpose(1, 2)
 
-        qr = theta_shift(q, sin, cos)
-        kr = theta_shift(k, sin, cos)
+        qr = theta_shift(q, rotation)
+        kr = theta_shift(k, rotation)
 
-        if incremental_state is not None:
+        if incremental_state is not None and not chunkwise_recurrent:
             output = self.recurrent_forward(qr, kr, v, inner_mask, incremental_state)
         elif chunkwise_recurrent:
-            output = self.chunk_recurrent_forward(qr, kr, v, inner_mask)
+            output = self.chunk_recurrent_forward(qr, kr, v, inner_mask, segment_ids)
+            if incremental_state is not None:
+                # Prefill: hand the prompt over to recurrent steps
+                self.prefill_state(kr, v, state_decay, incremental_state)
+        elif self.args.parallel_block_size:
+            output = self.tiled_parallel_forward(qr, kr, v, inner_mask)
         else:
             output = self.parallel_forward(qr, kr, v, inner_mask)
         
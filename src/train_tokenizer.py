@@ -1,9 +1,12 @@
 import dask
-dask.config.set({"dataframe.query-planning": True})
-import dask.dataframe as dd
+from dask.diagnostics import ProgressBar
+import heapq
+import numpy as np
+import pyarrow.parquet as pq
 import sys
 import yaml
 
+from collections import Counter
 from pathlib import Path
 from tokenizers import decoders, pre_tokenizers, processors, Tokenizer
 from tokenizers.models import BPE
@@ -12,39 +15,155 @@ from transformers import PreTrainedTokenizerFast
 from utils import Struct
 
 
-def train_tokenizer(config):
-    
-    print(f"Data dir: {config.raw_dataset_path}")
-    print("Loading dataset from disk")
-
-    train_dataset_path = Path(config.raw_dataset_path) / "train" / "*.parquet"
-
-    # Only load in train set, as that's all the tokenizer needs.
-    dataset = dd.read_parquet(path=train_dataset_path,
-                              columns=[str(config.dataset_feature)]).compute()
-
-    print("Loaded!")
-
-    print("Creating tokenizer")
+# Longest run of one pre-token fed to the trainer as a single string
+MAX_REPEATS = 2**16
+
+def iter_texts(path: Path, feature: str, batch_size: int=1024):
+    """ Yields the non-null documents of a parquet file, reading it in record
+    batches so only one batch is in memory at a time.
+    Args:
+        path (Path): Path of the parquet file.
+        feature (str): Column holding the text.
+        batch_size (int): Number of rows read at a time.
+    """
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=batch_size,
+                                           columns=[feature]):
+        for text in batch.column(0).to_pylist():
+            if text is not None:
+                yield text
+
+def sample_texts(texts, byte_budget: int, rng: np.random.Generator) -> list:
+    """ Reservoir-sample documents up to a byte budget: every document gets a
+    random priority and the lowest-priority documents that fit in the budget
+    are kept, so the sample is uniform over documents and memory stays
+    within the budget.
+    Args:
+        texts (Iterator[str]): Documents to sample from.
+        byte_budget (int): Maximum number of UTF-8 bytes to keep.
+        rng (Generator): Random number generator for the priorities.
+    """
+    reservoir = []
+    num_bytes = 0
+    for text in texts:
+        text_bytes = len(text.encode())
+        # Max-heap on priority, so the worst kept document is on top
+        heapq.heappush(reservoir, (-rng.random(), text_bytes, text))
+        num_bytes += text_bytes
+        while num_bytes > byte_budget:
+            _, text_bytes, _ = heapq.heappop(reservoir)
+            num_bytes -= text_bytes
+    return [text for _, _, text in reservoir]
+
+def count_pre_tokens(path: Path, feature: str, byte_budget: int,
+                     seed: int) -> Counter:
+    """ Count the pre-tokens (byte-level words) of one parquet file of the
+    training split, or of a byte_budget sample of its documents.
+    Args:
+        path (Path): Path of the parquet file.
+        feature (str): Column holding the text.
+        byte_budget (int): Bytes of documents to sample, or None for all.
+        seed (int): Seed for sampling.
+    """
+    pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+
+    texts = iter_texts(path, feature)
+    if byte_budget is not None:
+        texts = sample_texts(texts, byte_budget, np.random.default_rng(seed))
+
+    counts = Counter()
+    for text in texts:
+        counts.update(word for word, _ in pre_tokenizer.pre_tokenize_str(text))
+    return counts
+
+def merge_counts(*counts: Counter) -> Counter:
+    """ Add up pre-token counts. """
+    total = counts[0]
+    for other in counts[1:]:
+        total.update(other)
+    return total
+
+def iter_pre_tokens(counts: Counter):
+    """ Yields every pre-token as many times as it was counted, as strings of
+    newline-separated repeats (byte-level pre-tokens never contain a raw
+    newline), so the trainer only has to split them.
+    Args:
+        counts (Counter): Pre-token counts.
+    """
+    for word, count in counts.items():
+        while count > 0:
+            repeats = min(count, MAX_REPEATS)
+            yield (word + "\n") * repeats
+            count -= repeats
+
+def split_byte_budgets(paths: list, byte_budget: int) -> list:
+    """ Share a byte budget between parquet files by their size on disk.
+    Args:
+        paths (List[Path]): Parquet files of a split.
+        byte_budget (int): Total bytes to sample, or None for all.
+    """
+    if byte_budget is None:
+        return [None] * len(paths)
+    sizes = np.array([path.stat().st_size for path in paths])
+    return (byte_budget * sizes / sizes.sum()).astype(np.int64).tolist()
+
+def count_train_pre_tokens(config, byte_budget: int=None) -> Counter:
+    """ Count the pre-tokens of the training split, or of a sample of about
+    byte_budget bytes of its documents, in parallel over its parquet files.
+    Args:
+        config (Struct): A Struct object with all configuration fields.
+        byte_budget (int): Bytes of documents to sample, or None for all.
+    """
+    # Only use the train set, as that's all the tokenizer needs.
+    train_paths = sorted(
+        (Path(config.raw_dataset_path) / "train").glob("*.parquet"))
+    budgets = split_byte_budgets(train_paths, byte_budget)
+
+    # Map: count pre-tokens of every file in parallel processes. Reduce:
+    # merge the counts pairwise in a tree
+    counts = [dask.delayed(count_pre_tokens)(
+                  path, config.dataset_feature, budget,
+                  [config.rand_seed or 0, i])
+              for i, (path, budget) in enumerate(zip(train_paths, budgets))]
+    while len(counts) > 1:
+        counts = [dask.delayed(merge_counts)(*counts[i:i + 2])
+                  for i in range(0, len(counts), 2)]
+    counts, = dask.compute(counts[0],
+                           scheduler="processes",
+                           num_workers=config.num_proc)
+
+    print(f"Counted {sum(counts.values())} pre-tokens " + \
+        f"({len(counts)} unique)")
+    return counts
+
+def train_bpe(counts: Counter, vocab_size: int,
+              show_progress: bool=True) -> Tokenizer:
+    """ Train a byte-level BPE tokenizer from pre-token counts, with its
+    pre-tokenizer, <bos> post-processor and decoder set up.
+    Args:
+        counts (Counter): Pre-token counts from count_train_pre_tokens.
+        vocab_size (int): Size of the vocabulary to learn.
+        show_progress (bool): Whether to show the trainer's progress bar.
+    """
     # Create BytePair Encoding tokenizer and trainer
     tokenizer = Tokenizer(BPE(unk_token="<unk>"))
     trainer = BpeTrainer(
-        vocab_size=config.vocab_size,
-        show_progress=True,
+        vocab_size=vocab_size,
+        show_progress=show_progress,
         special_tokens=["<pad>", "<bos>", "<unk>"])
 
+    # Train tokenizer on only training data. The counted pre-tokens are
+    # already byte-level, so the trainer just splits the repeats apart
+    tokenizer.pre_tokenizer = pre_tokenizers.Split("\n", behavior="removed")
+    tokenizer.train_from_iterator(
+        iter_pre_tokens(counts),
+        trainer=trainer)
+
     # Like GPT-2, we skip the normalizer and go directly to pre-tokenization.
     # The option we add to ByteLevel here is to not add a space at the beginning
     # of a sentence (which is the default otherwise)
     tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
 
-    print("Training tokenizer")
-    # Train tokenizer on only training data
-
-    tokenizer.train_from_iterator(
-        iter(dataset[config.dataset_feature]),
-        trainer=trainer)
-
     # trim_offsets=False tells post-processor to keep spaces as part of tokens
     tokenizer.post_processor = processors.TemplateProcessing(
         single="<bos> $A",
@@ -54,6 +173,19 @@ def train_tokenizer(config):
     # Add decoder for converting tokens back to text
     tokenizer.decoder = decoders.ByteLevel()
 
+    return tokenizer
+
+def train_tokenizer(config):
+    
+    print(f"Data dir: {config.raw_dataset_path}")
+    print("Counting pre-tokens")
+    if config.tokenizer_sample_bytes is not None:
+        print(f"Sampling {config.tokenizer_sample_bytes} bytes of documents")
+    counts = count_train_pre_tokens(config, config.tokenizer_sample_bytes)
+
+    print("Training tokenizer")
+    tokenizer = train_bpe(counts, config.vocab_size)
+
     # Enable padding
     tokenizer.enable_padding(
         direction="right",
@@ -85,6 +217,8 @@ def train_tokenizer(config):
 
 
 if __name__ == "__main__":
+    ProgressBar().register()
+
     args = sys.argv
     config_path = args[1]
 
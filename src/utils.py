@@ -5,6 +5,61 @@ import torch.nn.functional as F
 from tokenizers import Tokenizer
 from torch import nn
 
+def generate_recurrent(
+        model: nn.Module,
+        tokens: list[int],
+        device: torch.device,
+        num_tokens: int,
+        stop_token_id: int=None) -> tuple[list[int], list[float]]:
+    """ Greedily generate tokens with a model that decodes recurrently, such
+    as RetNet. The prompt is read at once through prefill, then one token per
+    step is fed through decode_step. The whole context is kept in the
+    recurrent state, so the time per token doesn't grow with the context and
+    it isn't cut to the sequence length.
+    Args:
+        model (nn.Module): Model with init_incremental_state, prefill and
+            decode_step methods, already on device and in eval mode.
+        tokens (list[int]): Token indices of the prompt.
+        device (torch.device): Device on which to run inference.
+        num_tokens (int): Maximum number of tokens to generate.
+        stop_token_id (int): Generation stops after this token, if given.
+
+    Returns:
+        The generated token indices, and the seconds taken to generate each
+        of them (the first includes reading the prompt).
+    """
+    # Preallocated prompt and generation; every step reads a view of it
+    token_buffer = torch.empty(
+        (1, len(tokens) + num_tokens), dtype=torch.long, device=device)
+    token_buffer[0, :len(tokens)] = torch.tensor(tokens, dtype=torch.long)
+    incremental_state = model.init_incremental_state(1, device=device)
+
+    generated_token_idxs = []
+    times = []
+    length = len(tokens)
+    start = time.time()
+    for step in range(num_tokens):
+        if step == 0:
+            predictions = model.prefill(token_buffer[:, :length],
+                                        incremental_state)
+        else:
+            predictions = model.decode_step(token_buffer[:, :length],
+                                            incremental_state)
+        predicted_id = predictions.argmax(dim=-1)[0]
+        token_buffer[0, length] = predicted_id
+        length += 1
+
+        # Reading the token waits for the device, so the time is accurate
+        generated_token_idxs.append(predicted_id.item())
+        end = time.time()
+        times.append(end - start)
+        start = end
+
+        if generated_token_idxs[-1] == stop_token_id:
+            break
+
+    return generated_token_idxs, times
+
 def generate_text(
         model: nn.Module,
         tokenizer: Tokenizer,
@@ -51,6 +106,23 @@ def generate_text(
             # Store generated sequence token indices
             generated_token_idxs = input_token_idxs
 
+            # Decode one token at a time where the model supports it. Like
+            # the loop below, this stops at padding or at generation_length,
+            # but on purpose it keeps the whole context in the recurrent state
+            # instead of cutting it to seq_len
+            if hasattr(model, "decode_step"):
+                new_token_idxs = []
+                if generated_token_idxs[-1] != tokenizer.pad_token_id:
+                    new_token_idxs, _ = generate_recurrent(
+                        model,
+                        input_token_idxs,
+                        device,
+                        max(0, generation_length - len(input_token_idxs)),
+                        stop_token_id=tokenizer.pad_token_id)
+                generated_token_idx_list.append(
+                    input_token_idxs + new_token_idxs)
+                continue
+
             # Get tensor with token indices
             input_tensor = torch.tensor(input_token_idxs, dtype=torch.long)
 
@@ -123,6 +195,16 @@ def generate_text_from_tokens(
         # Store generated sequence token indices
         generated_token_idxs = input_token_idxs
 
+        # Decode one token at a time where the model supports it. On purpose,
+        # the whole context is kept in the recurrent state instead of being
+        # cut to seq_len
+        if hasattr(model, "decode_step"):
+            _, times = generate_recurrent(
+                model, input_token_idxs, device, generation_length)
+            print('tokens generated: ', len(times))
+            print('time taken: ', sum(times))
+            return sum(times)
+
         # Get tensor with token indices
         input_tensor = torch.tensor(input_token_idxs, dtype=torch.long)
 
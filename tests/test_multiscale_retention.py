@@ -0,0 +1,176 @@
+import copy
+import pytest
+import sys
+import torch
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from torchscale.architecture.config import RetNetConfig
+from torchscale.architecture.retnet import RetNetDecoder, RetNetRelPos
+from torchscale.component.multiscale_retention import MultiScaleRetention
+
+# fp16 matmuls need a GPU on older PyTorch versions
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+TOLERANCES = {torch.float32: 1e-5, torch.float16: 1e-2}
+
+
+def build_retention(num_heads: int=4, key_dim: int=8, head_dim: int=16):
+    """ Retention module with the given head dimensions. """
+    config = RetNetConfig(decoder_embed_dim=num_heads * key_dim,
+                          decoder_value_embed_dim=num_heads * head_dim,
+                          decoder_retention_heads=num_heads)
+    return MultiScaleRetention(config, config.decoder_embed_dim,
+                               config.decoder_value_embed_dim, num_heads)
+
+def chunk_inputs(retention, bsz: int, num_chunks: int, resets: bool,
+                 dtype: torch.dtype):
+    """ Random per-chunk key-value sums, cross-chunk decay and, if resets is
+    set, a carry that restarts the state at random chunks.
+    """
+    generator = torch.Generator().manual_seed(0)
+    kv = torch.randn(bsz, num_chunks, retention.num_heads, retention.key_dim,
+                     retention.head_dim, generator=generator)
+    decay = torch.log(1 - 2 ** (-5 - torch.arange(retention.num_heads,
+                                                   dtype=torch.float)))
+    cross_decay = torch.exp(decay * 8)[:, None, None]
+    carry = None
+    if resets:
+        carry = (torch.rand(bsz, num_chunks, generator=generator) > 0.3).float()
+        carry = carry[:, :, None, None, None]
+    kv, cross_decay = kv.to(DEVICE, dtype), cross_decay.to(DEVICE)
+    if carry is not None:
+        carry = carry.to(DEVICE, dtype)
+    return kv, cross_decay, carry
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16])
+@pytest.mark.parametrize("resets", [False, True])
+@pytest.mark.parametrize("num_chunks", [1, 7, 16])
+def test_scan_matches_loop(dtype, resets, num_chunks):
+    """ The parallel scan gives the loop's states and scales. """
+    retention = build_retention()
+    kv, cross_decay, carry = chunk_inputs(retention, 2, num_chunks, resets,
+                                          dtype)
+
+    loop_states, loop_scales = retention.loop_chunk_states(kv, cross_decay, carry)
+    scan_states, scan_scales = retention.scan_chunk_states(kv, cross_decay, carry)
+
+    tolerance = TOLERANCES[dtype]
+    torch.testing.assert_close(scan_states.to(loop_states), loop_states,
+                               rtol=tolerance, atol=tolerance)
+    torch.testing.assert_close(scan_scales.to(loop_scales), loop_scales,
+                               rtol=tolerance, atol=tolerance)
+
+@pytest.mark.parametrize("resets", [False, True])
+def test_scan_gradients_match_loop(resets):
+    """ Gradients through the parallel scan match those through the loop. """
+    retention = build_retention()
+    kv, cross_decay, carry = chunk_inputs(retention, 2, 9, resets,
+                                          torch.float32)
+
+    gradients = []
+    for chunk_states in (retention.loop_chunk_states,
+                         retention.scan_chunk_states):
+        kv_input = kv.clone().requires_grad_()
+        states, _ = chunk_states(kv_input, cross_decay, carry)
+        states.pow(2).sum().backward()
+        gradients.append(kv_input.grad)
+
+    torch.testing.assert_close(gradients[1], gradients[0], rtol=1e-5, atol=1e-5)
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16])
+@pytest.mark.parametrize("segments", [False, True])
+@pytest.mark.parametrize("incremental", [False, True])
+def test_decoder_scan_matches_loop(dtype, segments, incremental):
+    """ Chunkwise decoding, with document segments or prefilling an incoming
+    recurrent state that later steps decode from, gives the same outputs and
+    states with either scan.
+    """
+    torch.manual_seed(0)
+    config = RetNetConfig(decoder_embed_dim=32, decoder_value_embed_dim=64,
+                          decoder_retention_heads=4, decoder_ffn_embed_dim=64,
+                          decoder_layers=2, dropout=0.0, vocab_size=100,
+                          chunkwise_recurrent=True, recurrent_chunk_size=4)
+    embeddings = torch.nn.Embedding(config.vocab_size, config.decoder_embed_dim)
+    loop_decoder = RetNetDecoder(config, embed_tokens=embeddings)
+    scan_config = copy.deepcopy(config)
+    scan_config.recurrent_chunk_scan = "parallel"
+    scan_decoder = RetNetDecoder(scan_config, embed_tokens=embeddings)
+    scan_decoder.load_state_dict(loop_decoder.state_dict())
+
+    tokens = torch.randint(1, config.vocab_size, (2, 24), device=DEVICE)
+    segment_ids = None
+    if segments:
+        segment_ids = torch.tensor([[0] * 5 + [1] * 11 + [2] * 8, [0] * 24],
+                                   device=DEVICE)
+
+    results = []
+    for decoder in (loop_decoder, scan_decoder):
+        decoder = decoder.to(DEVICE, dtype).eval()
+        with torch.no_grad():
+            if not incremental:
+                output, _ = decoder(tokens, segment_ids=segment_ids)
+                results.append((output, []))
+                continue
+            state = decoder.init_incremental_state(2, DEVICE, dtype)
+            state["is_first_step"] = True
+            output, _ = decoder(tokens[:, :20], incremental_state=state)
+            outputs = [output[:, -1]]
+            for length in range(21, 25):
+                output, _ = decoder(tokens[:, :length], incremental_state=state)
+                outputs.append(output[:, -1])
+            states = [layer_state[key] for layer_state in state.values()
+                      if isinstance(layer_state, dict)
+                      for key in ("prev_key_value", "scale")]
+            results.append((torch.stack(outputs, dim=1), states))
+
+    tolerance = TOLERANCES[dtype]
+    (loop_output, loop_states), (scan_output, scan_states) = results
+    torch.testing.assert_close(scan_output, loop_output,
+                               rtol=tolerance, atol=tolerance)
+    for scan_state, loop_state in zip(scan_states, loop_states):
+        torch.testing.assert_close(scan_state, loop_state,
+                                   rtol=tolerance, atol=tolerance)
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float64])
+@pytest.mark.parametrize("segments", [False, True])
+@pytest.mark.parametrize("block_size", [4, 5, 16])
+def test_tiled_matches_parallel(dtype, segments, block_size):
+    """ Tiled retention gives the outputs and gradients of the full parallel
+    mask, with or without document segments, also for blocks that don't
+    divide the sequence length.
+    """
+    torch.manual_seed(0)
+    config = RetNetConfig(decoder_embed_dim=32, decoder_value_embed_dim=64,
+                          decoder_retention_heads=4)
+    tiled_config = copy.deepcopy(config)
+    tiled_config.parallel_block_size = block_size
+    retention = MultiScaleRetention(config, 32, 64, 4).to(DEVICE, dtype)
+    tiled_retention = MultiScaleRetention(tiled_config, 32, 64, 4).to(DEVICE, dtype)
+    tiled_retention.load_state_dict(retention.state_dict())
+
+    x = torch.randn(2, 13, 32, device=DEVICE, dtype=dtype)
+    segment_ids = None
+    if segments:
+        segment_ids = torch.tensor([[0] * 3 + [1] * 7 + [2] * 3, [0] * 13],
+                                   device=DEVICE)
+
+    results = []
+    for module, module_config in ((retention, config),
+                                  (tiled_retention, tiled_config)):
+        rel_pos = RetNetRelPos(module_config).to(DEVICE, dtype)
+        x_input = x.clone().requires_grad_()
+        output = module(x_input, rel_pos(13, segment_ids=segment_ids))
+        output.pow(2).sum().backward()
+        results.append((output, x_input.grad,
+                        [parameter.grad for parameter in module.parameters()]))
+
+    tolerance = 1e-5 if dtype == torch.float32 else 1e-10
+    (output, grad, grads), (tiled_output, tiled_grad, tiled_grads) = results
+    torch.testing.assert_close(tiled_output, output,
+                               rtol=tolerance, atol=tolerance)
+    torch.testing.assert_close(tiled_grad, grad, rtol=tolerance, atol=tolerance)
+    for tiled_parameter_grad, parameter_grad in zip(tiled_grads, grads):
+        torch.testing.assert_close(tiled_parameter_grad, parameter_grad,
+                                   rtol=tolerance, atol=tolerance)
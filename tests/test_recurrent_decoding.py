@@ -0,0 +1,92 @@
+import pytest
+import sys
+import torch
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from models import RetNetModelHF
+from torchscale.architecture.config import RetNetConfig
+
+# Bounds of the deviation of prefill from token-by-token decoding in float64
+# with the default layernorm_eps, past one chunk and with several layers
+FIRST_LOGITS_TOLERANCE = 2e-2
+LATER_LOGITS_TOLERANCE = 2e-3
+
+
+def decode(layers: int, chunk_size: int, prompt_len: int, seed: int,
+           layernorm_eps: float=1e-6, num_steps: int=10):
+    """ Decode num_steps tokens after a random prompt with a random float64
+    RetNet, once after prefilling the prompt and once feeding it token by
+    token. Returns the logits after the prompt and after every later token,
+    and the final recurrent states, of both.
+    """
+    torch.manual_seed(seed)
+    config = RetNetConfig(decoder_embed_dim=64, decoder_value_embed_dim=128,
+                          decoder_retention_heads=4, decoder_ffn_embed_dim=128,
+                          decoder_layers=layers, dropout=0.0, vocab_size=300,
+                          recurrent_chunk_size=chunk_size,
+                          layernorm_eps=layernorm_eps)
+    model = RetNetModelHF(config).double().eval()
+    tokens = torch.randint(1, config.vocab_size, (2, prompt_len + num_steps))
+
+    results = []
+    with torch.inference_mode():
+        for prefill in (True, False):
+            state = model.init_incremental_state(2)
+            if prefill:
+                logits = [model.prefill(tokens[:, :prompt_len], state)]
+            else:
+                logits = [model.decode_step(tokens[:, :length], state)
+                          for length in range(1, prompt_len + 1)][-1:]
+            logits += [model.decode_step(tokens[:, :length], state)
+                       for length in range(prompt_len + 1,
+                                           prompt_len + num_steps + 1)]
+            states = [layer_state[key] for layer_state in state.values()
+                      if isinstance(layer_state, dict)
+                      for key in ("prev_key_value", "scale")]
+            results.append((torch.stack(logits, dim=1), states))
+    return results
+
+@pytest.mark.parametrize("prompt_len", [1, 5, 8])
+def test_prefill_matches_within_chunk(prompt_len):
+    """ Prompts of up to one chunk leave the same logits and states as
+    decoding them token by token.
+    """
+    (logits, states), (step_logits, step_states) = decode(3, 8, prompt_len, 0)
+    torch.testing.assert_close(logits, step_logits, rtol=0, atol=1e-12)
+    for state, step_state in zip(states, step_states):
+        torch.testing.assert_close(state, step_state, rtol=0, atol=1e-12)
+
+def test_prefill_single_layer_state():
+    """ With a single layer, the state after a prompt of several chunks is the
+    same, so only the logits right after the prompt differ.
+    """
+    (logits, states), (step_logits, step_states) = decode(1, 8, 40, 0)
+    assert (logits[:, 0] - step_logits[:, 0]).abs().max() <= \
+        FIRST_LOGITS_TOLERANCE
+    torch.testing.assert_close(logits[:, 1:], step_logits[:, 1:],
+                               rtol=0, atol=1e-12)
+    for state, step_state in zip(states, step_states):
+        torch.testing.assert_close(state, step_state, rtol=0, atol=1e-12)
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("layers, chunk_size, prompt_len",
+                         [(2, 8, 41), (3, 8, 40), (4, 16, 100)])
+def test_prefill_tolerance(layers, chunk_size, prompt_len, seed):
+    """ Past one chunk, later layers read slightly different inputs, so the
+    logits after prefill stay within the documented tolerances.
+    """
+    (logits, _), (step_logits, _) = decode(layers, chunk_size, prompt_len,
+                                           seed)
+    deviation = (logits - step_logits).abs().amax(dim=(0, 2))
+    assert deviation[0] <= FIRST_LOGITS_TOLERANCE
+    assert deviation[1:].max() <= LATER_LOGITS_TOLERANCE
+
+def test_prefill_without_norm_eps():
+    """ The deviation comes from the group norm's epsilon: without it, the
+    chunkwise and recurrent outputs normalize to the same values.
+    """
+    (logits, _), (step_logits, _) = decode(3, 8, 40, 0, layernorm_eps=0.0)
+    torch.testing.assert_close(logits, step_logits, rtol=0, atol=1e-5)